@@ -1,13 +1,411 @@
-from flask import Flask, request, jsonify
-from flask_cors import CORS
-import pdfplumber
-import io
-import os
-import re
-from datetime import datetime
+import _thread
+import builtins
+import sys
+import time
+
+# =============================================================================
+# 起動時間の計測と重いモジュールの遅延読み込み
+# =============================================================================
+# Renderの無料プランはアイドル時にスリープするため、コールドスタートのたびに
+# pdfplumber（pdfminer等を含む）やnumpyの読み込みを待つと /health の応答が遅れる。
+# これらは最初に使われた時点で読み込み、パッケージごとの読み込み時間を記録する。
+# 標準ライブラリも含めて計測できるよう、計測に必要な組み込みモジュール以外はすべて計測を始めてから読み込む。
+
+_STARTUP_BEGAN = time.perf_counter()
+
+# {トップレベルパッケージ名: {"seconds": 自己時間, "lazy": 遅延読み込みか}}
+IMPORT_TIMINGS = {}
+# {イベント名: 起動開始からの秒数}
+STARTUP_EVENTS = {}
+
+_import_lock = _thread.RLock()
+
+
+def record_startup_event(name):
+    """起動開始からの経過時間を記録する（最初の1回のみ）"""
+    if name not in STARTUP_EVENTS:
+        STARTUP_EVENTS[name] = round(time.perf_counter() - _STARTUP_BEGAN, 4)
+
+
+def _resolve_import_name(name, globals, level):
+    """相対importのモジュール名を絶対名にする（importlib.util.resolve_name と同じ規則）"""
+    if level == 0:
+        return name
+    package = (globals or {}).get('__package__') or ''
+    parts = package.rsplit('.', level - 1)
+    if not package or len(parts) < level:
+        return name
+    return f"{parts[0]}.{name}" if name else parts[0]
+
+
+class _ImportTracker:
+    """track_imports の本体（contextlib等を読み込む前から使うため、クラスで実装する）"""
+
+    def __init__(self, lazy):
+        self.lazy = lazy
+
+    def __enter__(self):
+        _import_lock.acquire()
+        self.original_import = builtins.__import__
+        owner = _thread.get_ident()
+        stack = []
+        original_import = self.original_import
+        lazy = self.lazy
+
+        def timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+            if _thread.get_ident() != owner:
+                # 同時に動いている他のリクエストのimportは集計しない
+                return original_import(name, globals, locals, fromlist, level)
+            absolute = _resolve_import_name(name, globals, level)
+            if not absolute or absolute in sys.modules:
+                return original_import(name, globals, locals, fromlist, level)
+
+            root = absolute.partition('.')[0]
+            frame = [root, 0.0]
+            stack.append(frame)
+            started = time.perf_counter()
+            try:
+                module = original_import(name, globals, locals, fromlist, level)
+            finally:
+                elapsed = time.perf_counter() - started
+                stack.pop()
+                if stack:
+                    stack[-1][1] += elapsed
+            # 読み込みに失敗したもの（プラットフォーム依存のモジュール等）は記録しない
+            entry = IMPORT_TIMINGS.setdefault(root, {"seconds": 0.0, "lazy": lazy})
+            entry["seconds"] += elapsed - frame[1]
+            return module
+
+        builtins.__import__ = timed_import
+        return self
+
+    def __exit__(self, *exc_info):
+        builtins.__import__ = self.original_import
+        _import_lock.release()
+        return False
+
+
+def track_imports(lazy=False):
+    """
+    このブロック内で新しく読み込まれたパッケージの読み込み時間を記録する
+    入れ子のimportは親から差し引き、パッケージごとの自己時間を集計する
+    __import__ は全スレッドで差し替わるため、ブロックを実行しているスレッドのimportだけを記録する
+    """
+    return _ImportTracker(lazy)
+
+
+with track_imports():
+    import bisect
+    import fcntl
+    import hashlib
+    import io
+    import json
+    import math
+    import multiprocessing
+    import os
+    import re
+    import tempfile
+    import threading
+    import uuid
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+    from concurrent.futures.process import BrokenProcessPool
+    from contextlib import contextmanager
+    from datetime import datetime
+
+    from flask import Flask, request, jsonify, g, has_request_context
+    from flask_cors import CORS
+
+
+class LazyModule:
+    """属性に初めてアクセスした時点でモジュールを読み込むプロキシ"""
+
+    # {モジュール名: LazyModule}（起動後の先読みに使用）
+    instances = {}
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        LazyModule.instances[name] = self
+
+    def _load(self):
+        if self._module is None:
+            with track_imports(lazy=True):
+                if self._module is None:
+                    # import文経由で読み込み、依存パッケージの時間も記録する
+                    __import__(self._name)
+                    self._module = sys.modules[self._name]
+            record_startup_event(f"lazy_import:{self._name}")
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+
+# 抽出処理で初めて必要になる重いモジュール
+pdfplumber = LazyModule('pdfplumber')
+np = LazyModule('numpy')
+# ASGIモード（uvicorn）でのみ使用する
+asyncio = LazyModule('asyncio')
 
 app = Flask(__name__)
 CORS(app)
+# [memory] などの処理ログはINFOで出す（Gunicornではエラーログに出力される）
+app.logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+
+
+# =============================================================================
+# アドミッション制御（高速レーン / 重量レーン）
+# =============================================================================
+# 小さな領収書と大きな請求書が同じワーカーを先着順で奪い合わないように、
+# アップロードを解析前に軽く検査して、別々の実行レーンに振り分ける。
+# 各レーンは同時実行数と待ち行列の深さを持ち、溢れた場合は429を返す。
+# レーンはプロセスごとのセマフォなので、上限はGunicornのワーカーごとに効く
+# （全体の同時実行数は ワーカー数 × 各レーンの同時実行数）。あるワーカーで重量レーンが
+# 溢れて429を返しても、別のワーカーの重量レーンは空いていることがある。
+# また同じプロセス内の高速レーンと重量レーンはGILを共有するため、CPUを使う解析同士は
+# 完全には分離されない。レーンが防ぐのは、重い解析がワーカーのスレッドを使い切ることである。
+
+# 高速レーンに入れるアップロードの上限（これを超えると重量レーン）
+FAST_LANE_MAX_BYTES = int(os.environ.get('FAST_LANE_MAX_BYTES', 2 * 1024 * 1024))
+FAST_LANE_MAX_PAGES = int(os.environ.get('FAST_LANE_MAX_PAGES', 3))
+
+
+class LaneSaturatedError(Exception):
+    """レーンが飽和していて新しいリクエストを受け付けられない"""
+
+    def __init__(self, lane, retry_after):
+        super().__init__(f"{lane.name} lane is saturated")
+        self.lane = lane
+        self.retry_after = retry_after
+
+
+class AdmissionLane:
+    """
+    同時実行数と待ち行列の深さを持つ実行レーン
+    max_concurrency: 同時に解析できるリクエスト数
+    max_queue: 空きを待てるリクエスト数（これを超えると即座に429）
+    """
+
+    def __init__(self, name, max_concurrency, max_queue, queue_timeout):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._slots = threading.Semaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._active = 0
+        self._waiting = 0
+        # 処理時間の移動平均（Retry-Afterの見積もりに使用）
+        self._avg_seconds = 1.0
+
+    def retry_after(self):
+        """待ち行列が捌けるまでのおおよその秒数"""
+        with self._lock:
+            backlog = self._active + self._waiting
+            estimate = self._avg_seconds * backlog / self.max_concurrency
+        return max(1, math.ceil(estimate))
+
+    @contextmanager
+    def slot(self):
+        """レーンの実行枠を確保する。確保できなければLaneSaturatedErrorを送出"""
+        acquired = self._slots.acquire(blocking=False)
+        if not acquired:
+            with self._lock:
+                if self._waiting >= self.max_queue:
+                    saturated = True
+                else:
+                    saturated = False
+                    self._waiting += 1
+            if saturated:
+                raise LaneSaturatedError(self, self.retry_after())
+            try:
+                acquired = self._slots.acquire(timeout=self.queue_timeout)
+            finally:
+                with self._lock:
+                    self._waiting -= 1
+            if not acquired:
+                raise LaneSaturatedError(self, self.retry_after())
+
+        with self._lock:
+            self._active += 1
+        started = time.monotonic()
+        try:
+            yield self
+        finally:
+            elapsed = time.monotonic() - started
+            with self._lock:
+                self._active -= 1
+                self._avg_seconds = self._avg_seconds * 0.8 + elapsed * 0.2
+            self._slots.release()
+
+
+FAST_LANE = AdmissionLane(
+    'fast',
+    max_concurrency=int(os.environ.get('FAST_LANE_CONCURRENCY', 4)),
+    max_queue=int(os.environ.get('FAST_LANE_QUEUE', 16)),
+    queue_timeout=float(os.environ.get('FAST_LANE_QUEUE_TIMEOUT', 10))
+)
+HEAVY_LANE = AdmissionLane(
+    'heavy',
+    max_concurrency=int(os.environ.get('HEAVY_LANE_CONCURRENCY', 1)),
+    max_queue=int(os.environ.get('HEAVY_LANE_QUEUE', 2)),
+    queue_timeout=float(os.environ.get('HEAVY_LANE_QUEUE_TIMEOUT', 60))
+)
+
+
+# ページツリーの辞書を探すためのトークン（辞書の開始・終了、/Type /Pages、/Count）
+PAGE_TREE_TOKEN_PATTERN = re.compile(rb'<<|>>|/Type\s*/Pages\b|/Count\s+(\d{1,9})')
+PAGE_TREE_MAX_DEPTH = 64
+
+
+def count_page_tree(pdf_bytes):
+    """
+    /Type /Pages の辞書にある /Count の最大値（ルートのページ数）を返す
+    辞書の入れ子を1回の走査で追うため、細工されたファイルでも入力の長さに比例した時間で終わる
+    """
+    pages = None
+    # 開いている辞書ごとの [/Type /Pages か, /Count の値]
+    stack = []
+    for match in PAGE_TREE_TOKEN_PATTERN.finditer(pdf_bytes):
+        token = match.group(0)
+        if token == b'<<':
+            if len(stack) >= PAGE_TREE_MAX_DEPTH:
+                # 壊れた入れ子は捨てて数え直す
+                stack.clear()
+            stack.append([False, None])
+        elif token == b'>>':
+            if stack:
+                is_pages, count = stack.pop()
+                if is_pages and count is not None:
+                    pages = max(pages or 0, count)
+        elif stack:
+            if match.group(1) is not None:
+                stack[-1][1] = int(match.group(1))
+            else:
+                stack[-1][0] = True
+    return pages
+
+
+def inspect_upload(pdf_bytes):
+    """
+    PDFを解析せずにバイト列だけで軽く検査する
+    返り値: {"bytes": int, "pages": int or None, "format": str}
+    format: pdf / encrypted / unknown
+    """
+    head = pdf_bytes[:1024]
+    if b'%PDF-' not in head:
+        return {"bytes": len(pdf_bytes), "pages": None, "format": "unknown"}
+
+    # ページツリーの /Count の最大値がページ数（ルートの /Pages）
+    pages = count_page_tree(pdf_bytes)
+    if pages is None:
+        # オブジェクトストリーム内にページツリーがある場合は数えられない
+        page_objects = len(re.findall(rb'/Type\s*/Page(?![a-zA-Z])', pdf_bytes))
+        pages = page_objects or None
+
+    pdf_format = 'encrypted' if b'/Encrypt' in pdf_bytes else 'pdf'
+    return {"bytes": len(pdf_bytes), "pages": pages, "format": pdf_format}
+
+
+def choose_lane(profiles):
+    """
+    アップロードの検査結果から実行レーンを選ぶ
+    複数ファイルの場合は合計サイズ・合計ページ数で判定
+    """
+    total_bytes = sum(p['bytes'] for p in profiles)
+    total_pages = sum(p['pages'] or 1 for p in profiles)
+    if any(p['format'] == 'encrypted' for p in profiles):
+        # 暗号化PDFは復号に時間がかかるため重量レーン
+        return HEAVY_LANE
+    if total_bytes > FAST_LANE_MAX_BYTES or total_pages > FAST_LANE_MAX_PAGES:
+        return HEAVY_LANE
+    return FAST_LANE
+
+
+def lane_saturated_response(error):
+    """429 + Retry-After のレスポンスを作成"""
+    response = jsonify({
+        "error": "現在混み合っています。しばらくしてから再度お試しください",
+        "lane": error.lane.name,
+        "retry_after": error.retry_after
+    })
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response, 429
+
+
+# =============================================================================
+# 抽出結果のキャッシュ（ファイルのSHA-256をキーにする）
+# =============================================================================
+# 同じPDFを再アップロードした場合は解析結果を再利用する。
+# Gunicornの複数ワーカーで共有できるよう、結果はディレクトリにJSONで保存する。
+# 抽出ロジックを変更したら EXTRACTION_CACHE_VERSION を上げて古い結果を無効にする。
+
+EXTRACTION_CACHE_VERSION = '4'
+RESULT_CACHE_DIR = os.environ.get(
+    'RESULT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'babysitter-results')
+)
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get('RESULT_CACHE_MAX_ENTRIES', 512))
+SHA256_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+
+def content_hash(pdf_bytes):
+    """PDFのSHA-256（16進数）"""
+    return hashlib.sha256(pdf_bytes).hexdigest()
+
+
+def make_etag(digest):
+    """抽出結果のETag（キャッシュのバージョンを含める）"""
+    return f'"v{EXTRACTION_CACHE_VERSION}-{digest}"'
+
+
+def _result_cache_path(digest):
+    return os.path.join(RESULT_CACHE_DIR, f"v{EXTRACTION_CACHE_VERSION}", f"{digest}.json")
+
+
+def load_cached_result(digest):
+    """保存済みの抽出結果を返す。なければNone"""
+    try:
+        with open(_result_cache_path(digest), encoding='utf-8') as f:
+            entry = json.load(f)
+        return entry['payload'], entry['status']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def write_json_atomic(path, data):
+    """JSONを保存する。書きかけのファイルを読まれないよう、一時ファイルに書いてから置き換える"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def store_cached_result(digest, payload, status):
+    """抽出結果を保存する（保存に失敗しても処理は続ける）"""
+    path = _result_cache_path(digest)
+    try:
+        write_json_atomic(path, {"payload": payload, "status": status})
+        _prune_result_cache(os.path.dirname(path))
+    except OSError:
+        pass
+
+
+def _prune_result_cache(directory, companions=()):
+    """
+    上限を超えた場合は古いものから削除する
+    companions: 一緒に削除するファイルの拡張子（同じ名前で拡張子だけが違うもの）
+    """
+    entries = [e for e in os.scandir(directory) if e.name.endswith('.json')]
+    if len(entries) <= RESULT_CACHE_MAX_ENTRIES:
+        return
+    entries.sort(key=lambda e: e.stat().st_mtime)
+    for entry in entries[:len(entries) - RESULT_CACHE_MAX_ENTRIES]:
+        for path in [entry.path] + [entry.path[:-len('.json')] + ext for ext in companions]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
 
 
 def parse_kidsline_receipt(text):
@@ -102,41 +500,283 @@ def parse_kidsline_receipt(text):
     return result
 
 
+# =============================================================================
+# 事業者判定レジストリ
+# =============================================================================
+# 事業者ごとに判定用の文字列（シグネチャ）と使用するパーサーを登録する。
+# 全事業者のシグネチャを1つの正規表現（選択肢）にまとめるため、
+# 事業者がいくつ増えてもテキストの走査は1回で済む。
+
+class SignatureMatcher:
+    """
+    複数パターンを1回の走査で検索する（正規表現の選択肢を1つにまとめてコンパイルする）
+    半角スペースは読み飛ばすため、「領収書 兼 利用明細書」と「領収書兼利用明細書」は同じ扱い
+    一致ごとに1文字後ろから探し直すため、重なり合うパターン（「スマートシッター」と「シッターキッズ」など）も見つかる
+    各位置で選択肢を順に試すため、最悪の場合の計算量は テキストの長さ × パターン数 になる
+    """
+
+    SKIP_CHARS = ' '
+
+    def __init__(self, patterns):
+        self._patterns = {self._normalize(p): p for p in patterns}
+        # 長いパターンを先に試す（テキストは小文字にしてから検索するので大文字小文字は区別しない）
+        alternatives = sorted(self._patterns, key=len, reverse=True)
+        body = '|'.join(' *'.join(re.escape(ch) for ch in key) for key in alternatives)
+        self._regex = re.compile(body) if alternatives else None
+
+    @classmethod
+    def _normalize(cls, text):
+        return ''.join(ch for ch in text.lower() if ch not in cls.SKIP_CHARS)
+
+    def find_all(self, text):
+        """テキストを1回走査して、見つかったパターンの集合を返す"""
+        found = set()
+        if self._regex is None:
+            return found
+        text = text.lower()
+        search = self._regex.search
+        # 一致した文字列ごとの、その中に含まれるパターン
+        contained = {}
+        match = search(text)
+        while match:
+            matched = match.group(0)
+            if matched not in contained:
+                # 一致した部分に含まれる短いパターン（例: 「株式会社キッズライン」の「キッズライン」）も含める
+                normalized = self._normalize(matched)
+                contained[matched] = [pattern for key, pattern in self._patterns.items() if key in normalized]
+                found.update(contained[matched])
+            # 一致した部分の途中から始まるパターンも探すため、次の検索は1文字後ろから始める
+            match = search(text, match.start() + 1)
+        return found
+
+
+# 事業者定義
+# markers: これがあれば確実にその事業者
+# weak_markers: 帳票の形式など、exclusionsが含まれない場合のみ採用する手がかり
+# exclusions: weak_markersを無効にする文字列（他事業者名など）
+# parser: kidsline（領収書テキスト解析） / invoice（請求書テーブル抽出）
+PROVIDER_REGISTRY = []
+_provider_matcher = None
+
+
+def register_provider(name, label, parser, markers, weak_markers=(), exclusions=()):
+    """事業者定義を登録し、判定用のパターンを作り直す"""
+    global _provider_matcher
+    PROVIDER_REGISTRY.append({
+        'name': name,
+        'label': label,
+        'parser': parser,
+        'markers': list(markers),
+        'weak_markers': list(weak_markers),
+        'exclusions': list(exclusions)
+    })
+    _provider_matcher = None
+
+
+def _get_provider_matcher():
+    global _provider_matcher
+    if _provider_matcher is None:
+        patterns = set()
+        for provider in PROVIDER_REGISTRY:
+            patterns.update(provider['markers'])
+            patterns.update(provider['weak_markers'])
+            patterns.update(provider['exclusions'])
+        _provider_matcher = SignatureMatcher(sorted(patterns))
+    return _provider_matcher
+
+
+def classify_provider(text):
+    """
+    テキストから事業者を判定する
+    返り値: {"provider": str or None, "label": str or None, "parser": str,
+             "matched": [...], "excluded_by": [...]}
+    どの事業者にも一致しない場合は請求書形式（invoice）として扱う
+    """
+    found = _get_provider_matcher().find_all(text)
+
+    # 確実な指標を持つ事業者を登録順に優先
+    for provider in PROVIDER_REGISTRY:
+        matched = [m for m in provider['markers'] if m in found]
+        if matched:
+            return {
+                "provider": provider['name'],
+                "label": provider['label'],
+                "parser": provider['parser'],
+                "matched": matched,
+                "excluded_by": []
+            }
+
+    # 弱い指標は除外文字列が含まれない場合のみ採用
+    excluded_by = []
+    for provider in PROVIDER_REGISTRY:
+        matched = [m for m in provider['weak_markers'] if m in found]
+        if not matched:
+            continue
+        exclusions = [e for e in provider['exclusions'] if e in found]
+        if exclusions:
+            excluded_by.extend(exclusions)
+            continue
+        return {
+            "provider": provider['name'],
+            "label": provider['label'],
+            "parser": provider['parser'],
+            "matched": matched,
+            "excluded_by": []
+        }
+
+    return {
+        "provider": None,
+        "label": None,
+        "parser": 'invoice',
+        "matched": [],
+        "excluded_by": excluded_by
+    }
+
+
+def provider_fields(detection):
+    """判定結果のレスポンス用の項目（どの事業者に、どの文字列で一致したか）"""
+    return {
+        "provider": detection['provider'],
+        "provider_label": detection['label'],
+        # 一致した指標
+        "matched": detection['matched'],
+        # 弱い指標を無効にした除外文字列
+        "excluded_by": detection['excluded_by']
+    }
+
+
+# キッズライン
+# 注意: 「東京都ベビーシッター利用支援事業」や「ベビーシッター要件証明書」は
+# スマートシッター等の他サービスでも使われるため判定条件から除外
+# 「領収書 兼 利用明細書」はキッズライン特有の形式だが、他の事業者名がある場合は除外
+register_provider(
+    'kidsline', 'キッズライン', 'kidsline',
+    markers=['キッズライン', 'kidsline', '株式会社キッズライン'],
+    weak_markers=['領収書兼利用明細書'],
+    exclusions=['ポピンズ', 'スマートシッター', 'poppins']
+)
+# ポピンズシッター・スマートシッターは請求書形式として処理
+register_provider(
+    'poppins', 'ポピンズシッター', 'invoice',
+    markers=['ポピンズ', 'poppins']
+)
+register_provider(
+    'smartsitter', 'スマートシッター', 'invoice',
+    markers=['スマートシッター']
+)
+
+
 def is_kidsline_receipt(text):
     """
     テキストがキッズラインの領収書かどうかを判定する
-    
-    キッズライン特有の指標：
-    - 「キッズライン」または「KIDSLINE」という文字列
-    - 「領収書 兼 利用明細書」形式（キッズライン特有）
-    - 「株式会社キッズライン」
-    
-    注意: 「東京都ベビーシッター利用支援事業」や「ベビーシッター要件証明書」は
-    スマートシッター等の他サービスでも使われるため判定条件から除外
+    判定条件は事業者レジストリ（register_provider）を参照
     """
-    text_lower = text.lower()
-    
-    # キッズライン固有の指標（これらがあれば確実にキッズライン）
-    kidsline_specific = [
-        'キッズライン',
-        'kidsline',
-        '株式会社キッズライン'
-    ]
-    
-    for indicator in kidsline_specific:
-        if indicator.lower() in text_lower:
-            return True
-    
-    # 「領収書 兼 利用明細書」はキッズライン特有の形式
-    # ただし、他の事業者名（ポピンズシッターなど）が含まれていない場合のみ
-    if '領収書 兼 利用明細書' in text or '領収書兼利用明細書' in text.replace(' ', ''):
-        # 他の事業者名が含まれていないかチェック
-        other_providers = ['ポピンズ', 'スマートシッター', 'poppins']
-        has_other_provider = any(p.lower() in text_lower for p in other_providers)
-        if not has_other_provider:
-            return True
-    
-    return False
+    return classify_provider(text)['provider'] == 'kidsline'
+
+# =============================================================================
+# ページ単位のメモリ解放とメモリ使用量の記録
+# =============================================================================
+# pdfplumberのページは文字・図形・レイアウトのキャッシュを持ち続けるため、
+# 全ページを読み終えるまでメモリが増え続ける。読み終えたページのキャッシュはすぐに解放し、
+# リクエストごとのピークRSSと処理ページ数をログに出す。
+# RSSはプロセス全体の値なので、同時に処理中の他のリクエストの分も含まれる。
+
+# detect-pdf-format で事業者を探すページ数の上限
+FORMAT_DETECT_MAX_PAGES = int(os.environ.get('FORMAT_DETECT_MAX_PAGES', 1))
+
+
+def current_rss():
+    """現在のRSS（バイト）。取得できない環境ではNone"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def release_page(page):
+    """ページのキャッシュ（文字・図形・レイアウト・テキストマップ）を解放する"""
+    page.close()
+    # get_textmapはページごとのlru_cacheで、close()では解放されない
+    textmap_cache = getattr(page, 'get_textmap', None)
+    if hasattr(textmap_cache, 'cache_clear'):
+        textmap_cache.cache_clear()
+
+
+def _record_page_memory():
+    """処理したページ数とピークRSSをリクエストに記録する"""
+    if not has_request_context() or 'memory_stats' not in g:
+        return
+    stats = g.memory_stats
+    stats['pages'] += 1
+    rss = current_rss()
+    if rss is not None:
+        stats['peak_rss'] = max(stats['peak_rss'] or 0, rss)
+
+
+def _record_worker_memory(peak_rss):
+    """並列抽出の子プロセスのピークRSSをリクエストに加算する"""
+    if not has_request_context() or 'memory_stats' not in g or peak_rss is None:
+        return
+    g.memory_stats['worker_peak_rss'] += peak_rss
+
+
+def iter_pdf_pages(pdf, max_pages=None, start=0, end=None):
+    """
+    ページを順に返し、呼び出し側が次のページに進んだ時点で前のページを解放する
+    途中でbreakした場合も、そのページは解放される
+    start, end: 対象とするページ範囲（0始まり、endは含まない）
+    """
+    pages = pdf.pages[start:end]
+    if max_pages is not None:
+        pages = pages[:max_pages]
+    for page in pages:
+        try:
+            yield page
+        finally:
+            _record_page_memory()
+            release_page(page)
+
+
+def extract_pdf_text(pdf, max_pages=None, stop_when=None):
+    """
+    ページのテキストを結合して返す
+    stop_when: 各ページのテキストを受け取り、Trueを返したら残りのページは読まない
+    """
+    all_text = ''
+    for page in iter_pdf_pages(pdf, max_pages=max_pages):
+        page_text = page.extract_text() or ''
+        all_text += page_text + '\n'
+        if stop_when and stop_when(page_text):
+            break
+    return all_text
+
+
+def _provider_found(text):
+    return classify_provider(text)['provider'] is not None
+
+
+@app.before_request
+def start_memory_stats():
+    rss = current_rss()
+    g.memory_stats = {"pages": 0, "start_rss": rss, "peak_rss": rss, "worker_peak_rss": 0}
+
+
+@app.after_request
+def log_memory_stats(response):
+    stats = g.get('memory_stats')
+    if stats and stats['pages'] > 0:
+        to_mb = lambda value: f"{value / 1024 / 1024:.1f}MB" if value is not None else '-'
+        message = (
+            f"[memory] {request.method} {request.path} status={response.status_code} "
+            f"pages={stats['pages']} start_rss={to_mb(stats['start_rss'])} peak_rss={to_mb(stats['peak_rss'])}"
+        )
+        if stats['worker_peak_rss']:
+            # 並列抽出した子プロセスのピークRSSの合計（同時に動くため上限の目安）
+            message += f" worker_peak_rss={to_mb(stats['worker_peak_rss'])}"
+        app.logger.info(message)
+    return response
+
 
 # 標準ヘッダー（キッズライン領収書と請求書形式で統一）
 STANDARD_HEADER = [
@@ -186,9 +826,336 @@ def map_row_to_standard(row, header_indices):
     return standard_row
 
 
-def parse_invoice_table(pdf_file):
+# 「ご利用日」ヘッダーの表記ゆれ
+USAGE_DATE_KEYWORDS = ['ご利用日', 'ご利⽤⽇', '利用日', '利⽤⽇']
+USAGE_DATE_PATTERN = r'ご?利[用⽤][日⽇]'
+
+
+def find_usage_date_cell(tables, trace=None):
+    """
+    すべてのテーブルから「ご利用日」セルを探索する
+    複数見つかった場合は最も短い（最も具体的な）セルを選ぶ
+    trace: リストを渡すと、候補になったセルを記録する（診断用）
+    返り値: (テーブル番号, 行番号, 列番号) 見つからなければNone
+    """
+    target = None
+    min_cell_length = float('inf')
+
+    for table_idx, table in enumerate(tables):
+        if not table or len(table) == 0:
+            continue
+
+        for row_idx, row in enumerate(table):
+            if not row:
+                continue
+
+            for col_idx, cell in enumerate(row):
+                if cell:
+                    cell_str = str(cell).strip()
+                    normalized_cell = cell_str.replace(' ', '').replace('　', '')
+
+                    if any(keyword in normalized_cell for keyword in USAGE_DATE_KEYWORDS):
+                        cell_length = len(normalized_cell)
+                        if trace is not None:
+                            trace.append({
+                                "table_index": table_idx,
+                                "row": row_idx,
+                                "column": col_idx,
+                                "text": normalized_cell,
+                                "length": cell_length
+                            })
+                        if cell_length < min_cell_length:
+                            target = (table_idx, row_idx, col_idx)
+                            min_cell_length = cell_length
+
+    return target
+
+
+def trim_invoice_table(table, row_idx, col_idx):
+    """
+    「ご利用日」セルを左上としてテーブルを切り出し、空行・合計行を除いて整形する
+    返り値: 整形済みの行リスト（Noneは空文字列、改行はスペース）
+    """
+    # テーブルをトリミング
+    trimmed_table = []
+    for row in table[row_idx:]:
+        if row and len(row) > col_idx:
+            trimmed_row = row[col_idx:]
+            trimmed_table.append(trimmed_row)
+
+    # 空行と「合計」行を削除
+    filtered_table = []
+    for row in trimmed_table:
+        if not row or not any(cell for cell in row):
+            continue
+        row_text = ''.join([str(cell).replace(' ', '').replace('　', '') for cell in row if cell])
+        if '合計' in row_text or '⼩計' in row_text:
+            continue
+        filtered_table.append(row)
+
+    # Noneを空文字列に変換し、改行を削除
+    cleaned_table = []
+    for row in filtered_table:
+        if row:
+            cleaned_row = []
+            for cell in row:
+                if cell:
+                    cell_str = str(cell).replace('\n', ' ').replace('\r', ' ').strip()
+                    cell_str = ' '.join(cell_str.split())
+                    cleaned_row.append(cell_str)
+                else:
+                    cleaned_row.append("")
+            cleaned_table.append(cleaned_row)
+        else:
+            cleaned_table.append([])
+
+    return cleaned_table
+
+
+def build_header_indices(header, trace=None):
+    """
+    ヘッダー行を解析して標準形式へのマッピングを作る
+    trace: リストを渡すと、列ごとのマッピングの判断を記録する（診断用）
+    返り値: {標準インデックス: 元のインデックス}
+    """
+    header_indices = {}
+
+    for orig_idx, cell in enumerate(header):
+        normalized = normalize_header(cell)
+        decision = {"column": orig_idx, "header": normalized, "match": None, "key": None, "standard_index": None}
+        # 完全一致を優先
+        if normalized in HEADER_MAPPING:
+            std_idx = HEADER_MAPPING[normalized]
+            if std_idx not in header_indices:
+                header_indices[std_idx] = orig_idx
+                decision.update(match='exact', key=normalized, standard_index=std_idx)
+            else:
+                decision.update(match='duplicate', key=normalized, standard_index=std_idx)
+        else:
+            # 部分一致を試みる
+            for key, std_idx in HEADER_MAPPING.items():
+                if key in normalized or normalized in key:
+                    if std_idx not in header_indices:
+                        header_indices[std_idx] = orig_idx
+                        decision.update(match='partial', key=key, standard_index=std_idx)
+                        break
+        if trace is not None:
+            if decision['standard_index'] is not None:
+                decision['standard_header'] = STANDARD_HEADER[decision['standard_index']]
+            trace.append(decision)
+
+    return header_indices
+
+
+def standardize_invoice_table(cleaned_table, header_indices):
+    """整形済みのテーブルを標準形式に変換する"""
+    standardized_table = [STANDARD_HEADER.copy()]
+    for row in cleaned_table[1:]:  # ヘッダー行をスキップ
+        standardized_row = map_row_to_standard(row, header_indices)
+        standardized_table.append(standardized_row)
+
+    return {
+        "success": True,
+        "table": standardized_table,
+        "rows": len(standardized_table),
+        "columns": len(STANDARD_HEADER),
+        "original_columns": len(cleaned_table[0]),
+        "mapped_columns": len(header_indices)
+    }
+
+
+# =============================================================================
+# 請求書レイアウトのテンプレート
+# =============================================================================
+# 同じ事業者の請求書は表の位置や列の構成が毎回同じなので、初回の抽出に成功したら
+# 表の範囲・罫線の位置・ヘッダー行のマッピングをテンプレートとして保存する。
+# 2回目以降は「ご利用日」の位置から表の範囲だけを切り出して表を探すため、
+# ページ全体から罫線と表を探し直す処理を省ける。
+# テンプレートで抽出したヘッダー行が保存時と異なる場合は通常の抽出に戻る。
+# テンプレートを作れなかったレイアウト（事業者・ページサイズ・縦罫線の位置）は記録しておき、
+# LAYOUT_FAILURE_TTL 秒の間は学習と「ご利用日」の検索を省く。
+
+LAYOUT_TEMPLATE_DIR = os.path.join(RESULT_CACHE_DIR, 'layouts')
+LAYOUT_FAILURE_TTL = int(os.environ.get('LAYOUT_FAILURE_TTL', 24 * 60 * 60))
+_layout_templates = {}
+# {ページの指紋: {"failed_at": 学習に失敗した時刻 or None, "templates": [テンプレートの指紋]}}
+_layout_pages = {}
+
+
+def layout_fingerprint(page, anchor, provider):
+    """事業者・ページサイズ・「ご利用日」の位置からレイアウトの指紋を作る"""
+    key = '|'.join([
+        provider or 'unknown',
+        f"{round(page.width)}x{round(page.height)}",
+        anchor['text'],
+        str(round(anchor['x0'])),
+    ])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _layout_template_path(fingerprint):
+    return os.path.join(LAYOUT_TEMPLATE_DIR, f"v{EXTRACTION_CACHE_VERSION}", f"{fingerprint}.json")
+
+
+def load_layout_template(fingerprint):
+    """保存済みのレイアウトテンプレートを返す。なければNone"""
+    template = _layout_templates.get(fingerprint)
+    if template is None:
+        try:
+            with open(_layout_template_path(fingerprint), encoding='utf-8') as f:
+                template = json.load(f)
+        except (OSError, ValueError):
+            return None
+        _layout_templates[fingerprint] = template
+    return template
+
+
+def store_layout_template(fingerprint, template):
+    _layout_templates[fingerprint] = template
+    try:
+        write_json_atomic(_layout_template_path(fingerprint), template)
+    except OSError:
+        pass
+
+
+def layout_page_key(page, provider):
+    """
+    事業者・ページサイズ・縦罫線の位置からページの指紋を作る（「ご利用日」の検索前に分かる範囲）
+    縦罫線は列の構成で決まり、利用回数（行数）が変わっても同じになる
+    """
+    columns = sorted({round(edge['x0']) for edge in page.edges if edge['orientation'] == 'v'})
+    key = '|'.join([
+        provider or 'unknown',
+        f"{round(page.width)}x{round(page.height)}",
+        ','.join(map(str, columns))
+    ])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _layout_page_path(page_key):
+    return os.path.join(LAYOUT_TEMPLATE_DIR, f"v{EXTRACTION_CACHE_VERSION}", 'pages', f"{page_key}.json")
+
+
+def load_layout_page(page_key):
+    """ページの指紋ごとの学習結果を返す"""
+    record = _layout_pages.get(page_key)
+    if record is None:
+        try:
+            with open(_layout_page_path(page_key), encoding='utf-8') as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            record = {"failed_at": None, "templates": []}
+        _layout_pages[page_key] = record
+    return record
+
+
+def store_layout_page(page_key, record):
+    _layout_pages[page_key] = record
+    try:
+        write_json_atomic(_layout_page_path(page_key), record)
+    except OSError:
+        pass
+
+
+def layout_learning_failed(record):
+    """最近テンプレートの学習に失敗したページかどうか"""
+    failed_at = record.get('failed_at')
+    return failed_at is not None and time.time() - failed_at < LAYOUT_FAILURE_TTL
+
+
+def _template_table_settings(template):
+    """テンプレートの抽出方式に応じたpdfplumberの設定"""
+    if template['strategy'] == 'explicit':
+        # 縦罫線の位置を指定し、縦方向の罫線検出を省く
+        return {
+            'vertical_strategy': 'explicit',
+            'explicit_vertical_lines': template['vertical_lines'],
+            'horizontal_strategy': 'lines'
+        }
+    return {}
+
+
+def _template_region_tables(page, anchor, template):
+    """テンプレートの範囲を切り出して表を抽出し、整形済みの表を順に返す"""
+    x0, x1 = template['x0'], template['x1']
+    top = max(0, anchor['top'] - template['top_offset'])
+    if not (0 <= x0 < x1 <= page.width) or top >= page.height:
+        return
+
+    region = page.crop((x0, top, x1, page.height))
+    for table in region.extract_tables(_template_table_settings(template)):
+        if not table:
+            continue
+        cleaned_table = trim_invoice_table(table, 0, 0)
+        if len(cleaned_table) >= 2:
+            yield cleaned_table
+
+
+def extract_with_layout_template(page, anchor, template):
+    """
+    テンプレートを使って表の範囲だけから抽出する
+    ヘッダー行が保存時と一致しなければNone（通常の抽出に戻る）
+    """
+    header_indices = {int(k): v for k, v in template['header_indices'].items()}
+    for cleaned_table in _template_region_tables(page, anchor, template):
+        if [normalize_header(cell) for cell in cleaned_table[0]] == template['header']:
+            return standardize_invoice_table(cleaned_table, header_indices)
+    return None
+
+
+def learn_layout_template(page, anchors, table, row_idx, col_idx, expected_table):
+    """
+    通常の抽出結果からテンプレートを作る
+    切り出した範囲から抽出し直して同じ結果になる方式だけを保存する（罫線を指定する方式を優先）
+    ヘッダーのマッピングは切り出した表の列構成に合わせて作り直す
+    返り値: 保存したテンプレートの指紋（保存できなければNone）
+    """
+    header_cell = table.rows[row_idx].cells[col_idx]
+    if header_cell is None:
+        return None
+    cell_x0, cell_top, cell_x1, cell_bottom = header_cell
+
+    # ヘッダーセル内にある「ご利用日」の検索結果をテンプレートの基準にする
+    anchor = None
+    for fingerprint, candidate in anchors:
+        center_x = (candidate['x0'] + candidate['x1']) / 2
+        center_y = (candidate['top'] + candidate['bottom']) / 2
+        if cell_x0 <= center_x <= cell_x1 and cell_top <= center_y <= cell_bottom:
+            anchor = (fingerprint, candidate)
+            break
+    if anchor is None:
+        return None
+    fingerprint, anchor = anchor
+
+    # 切り出す範囲は「ご利用日」列から表の右端まで、ヘッダー行から下
+    top = max(0, cell_top - 1)
+    vertical_lines = sorted({round(c[0], 2) for c in table.cells if c[0] >= cell_x0 - 0.5})
+    vertical_lines.append(round(table.bbox[2], 2))
+    base = {
+        "x0": max(0, cell_x0 - 1),
+        "x1": min(page.width, table.bbox[2] + 1),
+        "top_offset": anchor['top'] - top,
+        "vertical_lines": vertical_lines
+    }
+
+    for strategy in ('explicit', 'lines'):
+        template = dict(base, strategy=strategy)
+        for cleaned_table in _template_region_tables(page, anchor, template):
+            header_indices = build_header_indices(cleaned_table[0])
+            relearned = standardize_invoice_table(cleaned_table, header_indices)
+            if relearned['table'] != expected_table:
+                continue
+            template['header'] = [normalize_header(cell) for cell in cleaned_table[0]]
+            template['header_indices'] = {str(k): v for k, v in header_indices.items()}
+            store_layout_template(fingerprint, template)
+            return fingerprint
+    return None
+
+
+def parse_invoice_table(pdf_file, provider=None):
     """
     請求書形式のPDFからテーブルを抽出する
+    provider: 判定済みの事業者名（レイアウトテンプレートの指紋に使用）
     返り値: {"success": bool, "table": [...], "error": str}
     """
     try:
@@ -199,127 +1166,291 @@ def parse_invoice_table(pdf_file):
             # 1ページ目を取得
             first_page = pdf.pages[0]
 
+            # 同じレイアウトのテンプレートがあれば表の範囲だけを抽出
+            page_key = layout_page_key(first_page, provider)
+            page_record = load_layout_page(page_key)
+            learning_failed = layout_learning_failed(page_record)
+            if learning_failed and not page_record['templates']:
+                # テンプレートを作れないレイアウトは「ご利用日」の検索を省く
+                anchors = []
+            else:
+                anchors = [
+                    (layout_fingerprint(first_page, anchor, provider), anchor)
+                    for anchor in first_page.search(USAGE_DATE_PATTERN)
+                ]
+            for fingerprint, anchor in anchors:
+                template = load_layout_template(fingerprint)
+                if template is None:
+                    continue
+                result = extract_with_layout_template(first_page, anchor, template)
+                if result:
+                    result['layout_template'] = fingerprint
+                    return result
+
             # テーブルを抽出
-            tables = first_page.extract_tables()
+            found_tables = first_page.find_tables()
+            tables = [found.extract() for found in found_tables]
 
             if not tables:
                 return {"success": False, "error": "テーブルが見つかりませんでした"}
 
             # すべてのテーブルから「ご利用日」セルを探索
-            target_table = None
-            target_row_idx = None
-            target_col_idx = None
-            min_cell_length = float('inf')
-
-            for table in tables:
-                if not table or len(table) == 0:
-                    continue
+            target = find_usage_date_cell(tables)
 
-                for row_idx, row in enumerate(table):
-                    if not row:
-                        continue
-
-                    for col_idx, cell in enumerate(row):
-                        if cell:
-                            cell_str = str(cell).strip()
-                            normalized_cell = cell_str.replace(' ', '').replace('　', '')
-
-                            if ('ご利用日' in normalized_cell or
-                                'ご利⽤⽇' in normalized_cell or
-                                '利用日' in normalized_cell or
-                                '利⽤⽇' in normalized_cell):
-                                cell_length = len(normalized_cell)
-                                if cell_length < min_cell_length:
-                                    target_table = table
-                                    target_row_idx = row_idx
-                                    target_col_idx = col_idx
-                                    min_cell_length = cell_length
-
-            if not target_table:
+            if not target:
                 return {"success": False, "error": "「ご利用日」を含むテーブルが見つかりませんでした"}
 
-            # テーブルをトリミング
-            trimmed_table = []
-            for row in target_table[target_row_idx:]:
-                if row and len(row) > target_col_idx:
-                    trimmed_row = row[target_col_idx:]
-                    trimmed_table.append(trimmed_row)
-
-            # 空行と「合計」行を削除
-            filtered_table = []
-            for row in trimmed_table:
-                if not row or not any(cell for cell in row):
-                    continue
-                row_text = ''.join([str(cell).replace(' ', '').replace('　', '') for cell in row if cell])
-                if '合計' in row_text or '⼩計' in row_text:
-                    continue
-                filtered_table.append(row)
-
-            if not filtered_table:
-                return {"success": False, "error": "テーブルのトリミングに失敗しました"}
-
-            # Noneを空文字列に変換し、改行を削除
-            cleaned_table = []
-            for row in filtered_table:
-                if row:
-                    cleaned_row = []
-                    for cell in row:
-                        if cell:
-                            cell_str = str(cell).replace('\n', ' ').replace('\r', ' ').strip()
-                            cell_str = ' '.join(cell_str.split())
-                            cleaned_row.append(cell_str)
-                        else:
-                            cleaned_row.append("")
-                    cleaned_table.append(cleaned_row)
-                else:
-                    cleaned_table.append([])
+            table_idx, row_idx, col_idx = target
+            cleaned_table = trim_invoice_table(tables[table_idx], row_idx, col_idx)
 
             if not cleaned_table:
-                return {"success": False, "error": "テーブルデータが空です"}
+                return {"success": False, "error": "テーブルのトリミングに失敗しました"}
 
             # ヘッダー行を解析して標準形式にマッピング
-            original_header = cleaned_table[0]
-            header_indices = {}  # {標準インデックス: 元のインデックス}
-            
-            for orig_idx, cell in enumerate(original_header):
-                normalized = normalize_header(cell)
-                # 完全一致を優先
-                if normalized in HEADER_MAPPING:
-                    std_idx = HEADER_MAPPING[normalized]
-                    if std_idx not in header_indices:
-                        header_indices[std_idx] = orig_idx
+            header_indices = build_header_indices(cleaned_table[0])
+            result = standardize_invoice_table(cleaned_table, header_indices)
+
+            # 次回以降のためにレイアウトを記録（最近失敗したレイアウトは学習し直さない）
+            if not learning_failed:
+                fingerprint = learn_layout_template(
+                    first_page, anchors, found_tables[table_idx], row_idx, col_idx, result['table']
+                )
+                if fingerprint:
+                    result['layout_template'] = fingerprint
+                    templates = sorted(set(page_record['templates']) | {fingerprint})
+                    store_layout_page(page_key, {"failed_at": None, "templates": templates})
                 else:
-                    # 部分一致を試みる
-                    for key, std_idx in HEADER_MAPPING.items():
-                        if key in normalized or normalized in key:
-                            if std_idx not in header_indices:
-                                header_indices[std_idx] = orig_idx
-                                break
-
-            # 標準形式のテーブルを作成
-            standardized_table = [STANDARD_HEADER.copy()]
-            for row in cleaned_table[1:]:  # ヘッダー行をスキップ
-                standardized_row = map_row_to_standard(row, header_indices)
-                standardized_table.append(standardized_row)
+                    store_layout_page(page_key, dict(page_record, failed_at=time.time()))
 
-            return {
-                "success": True,
-                "table": standardized_table,
-                "rows": len(standardized_table),
-                "columns": len(STANDARD_HEADER),
-                "original_columns": len(original_header),
-                "mapped_columns": len(header_indices)
-            }
+            return result
 
     except Exception as e:
         return {"success": False, "error": f"テーブル抽出エラー: {str(e)}"}
 
 
+# =============================================================================
+# 複数の領収書をまとめたPDFの分割
+# =============================================================================
+# キッズラインの領収書は1利用1ページだが、1か月分をまとめて1つのPDFにしたものもある。
+# 各ページの「領収日 :」を領収書の始まりとしてページ範囲に分け、領収書ごとに1行を作る。
+# ページ数が多いPDFはテキスト抽出（処理時間の大部分）を別プロセスで並列に行う。
+
+RECEIPT_START_PATTERN = re.compile(r'領収日\s*[：:]')
+
+# テキスト抽出を並列にするプロセス数（1以下なら並列にしない）と、並列にする最小ページ数
+PAGE_TEXT_WORKERS = int(os.environ.get('PAGE_TEXT_WORKERS', min(2, os.cpu_count() or 1)))
+PARALLEL_TEXT_MIN_PAGES = int(os.environ.get('PARALLEL_TEXT_MIN_PAGES', 8))
+
+_page_text_pool = None
+_page_text_pool_lock = threading.Lock()
+
+
+def _get_page_text_pool():
+    """テキスト抽出用のプロセスプールを初回に作る（スレッドを持つワーカーからforkしないようspawnを使う）"""
+    global _page_text_pool
+    with _page_text_pool_lock:
+        if _page_text_pool is None:
+            _page_text_pool = ProcessPoolExecutor(
+                max_workers=PAGE_TEXT_WORKERS,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return _page_text_pool
+
+
+def _reset_page_text_pool():
+    global _page_text_pool
+    with _page_text_pool_lock:
+        if _page_text_pool is not None:
+            _page_text_pool.shutdown(wait=False, cancel_futures=True)
+            _page_text_pool = None
+
+
+def _extract_page_texts_range(pdf_bytes, start, end):
+    """指定したページ範囲のテキストを返す"""
+    with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
+        return [page.extract_text() or '' for page in iter_pdf_pages(pdf, start=start, end=end)]
+
+
+def _extract_page_texts_in_worker(pdf_bytes, start, end):
+    """
+    子プロセスでページ範囲のテキストを抽出する
+    返り値: (テキストのリスト, 子プロセスのピークRSS)
+    """
+    texts = []
+    peak_rss = current_rss()
+    with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
+        for page in iter_pdf_pages(pdf, start=start, end=end):
+            texts.append(page.extract_text() or '')
+            rss = current_rss()
+            if rss is not None:
+                peak_rss = max(peak_rss or 0, rss)
+    return texts, peak_rss
+
+
+def extract_page_texts(pdf_bytes):
+    """
+    ページごとのテキストのリストを返す（ページがなければ空のリスト）
+    PARALLEL_TEXT_MIN_PAGES ページ以上のPDFは、ページ範囲に分けて並列に抽出する
+    """
+    with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
+        page_count = len(pdf.pages)
+        if page_count < PARALLEL_TEXT_MIN_PAGES or PAGE_TEXT_WORKERS < 2:
+            return [page.extract_text() or '' for page in iter_pdf_pages(pdf)]
+
+    chunk_size = math.ceil(page_count / PAGE_TEXT_WORKERS)
+    try:
+        pool = _get_page_text_pool()
+        futures = [
+            pool.submit(_extract_page_texts_in_worker, pdf_bytes, start, min(start + chunk_size, page_count))
+            for start in range(0, page_count, chunk_size)
+        ]
+        page_texts = []
+        for future in futures:
+            texts, peak_rss = future.result()
+            page_texts.extend(texts)
+            _record_worker_memory(peak_rss)
+    except BrokenProcessPool:
+        # 子プロセスが異常終了した場合はプールを作り直し、今回は順番に抽出する
+        _reset_page_text_pool()
+        return _extract_page_texts_range(pdf_bytes, 0, page_count)
+
+    for _ in page_texts:
+        _record_page_memory()
+    return page_texts
+
+
+def join_page_texts(page_texts):
+    """ページのテキストを1つのテキストに結合する"""
+    return ''.join(text + '\n' for text in page_texts)
+
+
+def split_receipt_pages(page_texts):
+    """
+    領収書の境界でページを分ける
+    返り値: [(開始ページ, 終了ページ)] ※0始まり、終了ページは含まない
+    「領収日」のないページは直前の領収書の続き（先頭の場合は最初の領収書）とする
+    """
+    if not page_texts:
+        return []
+    starts = [idx for idx, text in enumerate(page_texts) if RECEIPT_START_PATTERN.search(text)]
+    if not starts:
+        starts = [0]
+    starts[0] = 0
+    ends = starts[1:] + [len(page_texts)]
+    return list(zip(starts, ends))
+
+
+def receipt_to_row(data):
+    """キッズライン領収書の抽出結果を標準形式の1行にする"""
+    return [
+        data['date'],                           # ご利用日
+        data['start_time'],                     # 開始時刻
+        data['end_time'],                       # 終了時刻
+        data['sitter_name'] or '',              # シッター名
+        data['child_name'] or '',               # お子さま
+        str(data['childcare_fee']),             # 保育料(非課税) - 助成対象
+        '0',                                    # 保育料(税込10%)
+        str(data['option_fee']),                # オプション料(税込10%)
+        str(data['transport_fee']),             # 交通費(税込11%)
+        '0',                                    # 特別費用(税込10%)
+        '0',                                    # キャンセル料(不課税)
+        '0',                                    # 割引額
+        str(data['total_amount']),              # お支払い額
+        str(data['childcare_fee'])              # 助成対象金額（保育料）
+    ]
+
+
+def parse_kidsline_receipts(page_texts):
+    """
+    ページごとのテキストを領収書ごとに分けて解析する
+    返り値: [{"pages": [開始, 終了], "data": 抽出結果, "error": str or None}]
+    pagesは1始まりで、終了ページを含む
+    """
+    receipts = []
+    for start, end in split_receipt_pages(page_texts):
+        data = parse_kidsline_receipt(join_page_texts(page_texts[start:end]))
+        error = None
+        if not data['date'] or not data['start_time']:
+            error = "利用日時が抽出できませんでした"
+        receipts.append({"pages": [start + 1, end], "data": data, "error": error})
+    return receipts
+
+
+def kidsline_receipt_errors(receipts):
+    """解析に失敗した領収書の一覧（レスポンス用）"""
+    return [{"pages": r['pages'], "error": r['error']} for r in receipts if r['error']]
+
+
+def extract_auto_result(pdf_bytes):
+    """
+    単一PDFを自動判定して抽出する
+    返り値: (レスポンスの辞書, ステータスコード) ※filenameは呼び出し側で付与
+    """
+    # ページごとのテキストを取得
+    page_texts = extract_page_texts(pdf_bytes)
+    if not page_texts:
+        return {"error": "PDFにページがありません"}, 400
+    all_text = join_page_texts(page_texts)
+
+    # 事業者とフォーマットを判定
+    detection = classify_provider(all_text)
+
+    if detection['parser'] == 'kidsline':
+        # キッズライン領収書として処理（複数の領収書をまとめたPDFは領収書ごとに1行）
+        receipts = parse_kidsline_receipts(page_texts)
+        valid = [r['data'] for r in receipts if not r['error']]
+
+        if not valid:
+            return {
+                "success": False,
+                "error": "利用日時が抽出できませんでした",
+                "format": "kidsline",
+                "errors": kidsline_receipt_errors(receipts)
+            }, 400
+
+        # テーブル形式に変換（日付順）
+        rows = sorted((receipt_to_row(data) for data in valid), key=lambda x: x[0])
+        table = [STANDARD_HEADER.copy()] + rows
+
+        return {
+            "success": True,
+            "format": "kidsline",
+            "table": table,
+            "rows": len(table),
+            "columns": len(STANDARD_HEADER),
+            "child_name": valid[0]['child_name'],
+            "sitter_name": valid[0]['sitter_name'],
+            **provider_fields(detection),
+            "receipts": len(receipts),
+            "errors": kidsline_receipt_errors(receipts)
+        }, 200
+
+    # 請求書形式として処理
+    result = parse_invoice_table(io.BytesIO(pdf_bytes), provider=detection['provider'])
+
+    if not result['success']:
+        return {
+            "success": False,
+            "error": result['error'],
+            "format": "invoice"
+        }, 400
+
+    return {
+        "success": True,
+        "format": "invoice",
+        "table": result['table'],
+        "rows": result['rows'],
+        "columns": result['columns'],
+        **provider_fields(detection)
+    }, 200
+
+
 @app.route('/api/extract-auto', methods=['POST'])
 def extract_auto():
     """
     単一PDFを自動判定して抽出する
     キッズライン領収書か請求書形式かを自動判別
+    結果はファイルのSHA-256で保存し、同じファイルは再解析しない
     """
     try:
         if 'file' not in request.files:
@@ -334,94 +1465,104 @@ def extract_auto():
             return jsonify({"error": "PDFファイルのみアップロード可能です"}), 400
         
         pdf_bytes = file.read()
-        pdf_file = io.BytesIO(pdf_bytes)
-        
-        with pdfplumber.open(pdf_file) as pdf:
-            if len(pdf.pages) == 0:
-                return jsonify({"error": "PDFにページがありません"}), 400
-            
-            # 全ページのテキストを結合
-            all_text = ''
-            for page in pdf.pages:
-                page_text = page.extract_text() or ''
-                all_text += page_text + '\n'
-        
-        # フォーマットを判定
-        is_kidsline = is_kidsline_receipt(all_text)
-        
-        # ファイルポインタをリセット
-        pdf_file.seek(0)
-        
-        if is_kidsline:
-            # キッズライン領収書として処理
-            data = parse_kidsline_receipt(all_text)
-            
-            if not data['date'] or not data['start_time']:
-                return jsonify({
-                    "success": False,
-                    "error": "利用日時が抽出できませんでした",
-                    "format": "kidsline",
-                    "filename": file.filename
-                }), 400
-            
-            # テーブル形式に変換
-            row = [
-                data['date'],
-                data['start_time'],
-                data['end_time'],
-                data['sitter_name'] or '',
-                data['child_name'] or '',
-                str(data['childcare_fee']),
-                '0',
-                str(data['option_fee']),
-                str(data['transport_fee']),
-                '0',
-                '0',
-                '0',
-                str(data['total_amount']),
-                str(data['childcare_fee'])
-            ]
-            
-            return jsonify({
-                "success": True,
-                "format": "kidsline",
-                "filename": file.filename,
-                "table": [STANDARD_HEADER.copy(), row],
-                "rows": 2,
-                "columns": len(STANDARD_HEADER),
-                "child_name": data['child_name'],
-                "sitter_name": data['sitter_name']
-            })
-        
+        digest = content_hash(pdf_bytes)
+        etag = make_etag(digest)
+
+        cached = load_cached_result(digest)
+        if cached is not None:
+            payload, status = cached
         else:
-            # 請求書形式として処理
-            result = parse_invoice_table(pdf_file)
-            
-            if not result['success']:
-                return jsonify({
-                    "success": False,
-                    "error": result['error'],
-                    "format": "invoice",
-                    "filename": file.filename
-                }), 400
-            
-            return jsonify({
-                "success": True,
-                "format": "invoice",
-                "filename": file.filename,
-                "table": result['table'],
-                "rows": result['rows'],
-                "columns": result['columns']
-            })
+            lane = choose_lane([inspect_upload(pdf_bytes)])
+            with lane.slot():
+                payload, status = extract_auto_result(pdf_bytes)
+            store_cached_result(digest, payload, status)
+
+        payload = dict(payload, filename=file.filename, hash=digest)
+        response = jsonify(payload)
+        response.headers['ETag'] = etag
+        return response, status
     
+    except LaneSaturatedError as e:
+        return lane_saturated_response(e)
+    except Exception as e:
+        return jsonify({"error": f"エラーが発生しました: {str(e)}"}), 500
+
+
+@app.route('/api/extract-auto/preflight', methods=['POST'])
+def extract_auto_preflight():
+    """
+    アップロード前に、これから送るファイルのSHA-256を受け取る
+    解析済みのファイルは結果を返し、未解析のファイルのハッシュだけをmissingで返す
+    リクエスト: {"files": [{"hash": "...", "filename": "..."}]}
+    """
+    try:
+        data = request.json
+        if not data or not isinstance(data.get('files'), list):
+            return jsonify({"error": "filesが必要です"}), 400
+
+        results = {}
+        missing = []
+        for entry in data['files']:
+            if not isinstance(entry, dict):
+                return jsonify({"error": "filesの各要素は {\"hash\": ..., \"filename\": ...} の形式で指定してください"}), 400
+            digest = str(entry.get('hash', '')).lower()
+            if not SHA256_PATTERN.match(digest):
+                return jsonify({"error": f"不正なハッシュです: {digest}"}), 400
+
+            cached = load_cached_result(digest)
+            if cached is None:
+                if digest not in missing:
+                    missing.append(digest)
+                continue
+
+            payload, status = cached
+            results[digest] = dict(
+                payload,
+                filename=entry.get('filename', ''),
+                hash=digest,
+                status=status,
+                etag=make_etag(digest)
+            )
+
+        return jsonify({
+            "success": True,
+            "results": results,
+            "missing": missing
+        })
+
     except Exception as e:
         return jsonify({"error": f"エラーが発生しました: {str(e)}"}), 500
 
 
 @app.route('/health', methods=['GET'])
 def health():
+    record_startup_event('first_health')
     return jsonify({"status": "ok"})
 
+
+def startup_report():
+    """起動時間とパッケージごとの読み込み時間のレポート"""
+    imports = sorted(
+        ({"module": name, "seconds": round(entry["seconds"], 4), "lazy": entry["lazy"]}
+         for name, entry in IMPORT_TIMINGS.items()),
+        key=lambda item: item["seconds"],
+        reverse=True
+    )
+    return {
+        "events": STARTUP_EVENTS,
+        "imports": imports,
+        "lazy_modules": {
+            "pdfplumber": pdfplumber._module is not None,
+            "numpy": np._module is not None
+        }
+    }
+
+
+@app.route('/api/startup-report', methods=['GET'])
+def get_startup_report():
+    """起動時間とモジュールごとの読み込み時間を返す"""
+    return jsonify(startup_report())
+
 @app.route('/api/extract-kidsline', methods=['POST'])
 def extract_kidsline():
     """
@@ -442,9 +1583,12 @@ def extract_kidsline():
             return jsonify({"error": "ファイルがアップロードされていません"}), 400
         
         extracted_rows = []
+        receipt_errors = []
         child_name = None
         applicant_name = None
         
+        # 解析前にすべてのファイルを読み込んで検査する
+        uploads = []
         for file in files:
             if file.filename == '':
                 continue
@@ -452,56 +1596,42 @@ def extract_kidsline():
             if not file.filename.lower().endswith('.pdf'):
                 return jsonify({"error": f"{file.filename}: PDFファイルのみアップロード可能です"}), 400
             
-            pdf_bytes = file.read()
-            pdf_file = io.BytesIO(pdf_bytes)
-            
-            with pdfplumber.open(pdf_file) as pdf:
-                if len(pdf.pages) == 0:
+            uploads.append((file, file.read()))
+        
+        lane = choose_lane([inspect_upload(pdf_bytes) for _, pdf_bytes in uploads])
+        with lane.slot():
+            for file, pdf_bytes in uploads:
+                # ページごとのテキストを取得（読み終えたページはすぐに解放）
+                page_texts = extract_page_texts(pdf_bytes)
+                if not page_texts:
                     continue
                 
-                # 全ページのテキストを結合
-                all_text = ''
-                for page in pdf.pages:
-                    page_text = page.extract_text() or ''
-                    all_text += page_text + '\n'
-                
                 # キッズライン領収書かどうかをチェック
-                if not is_kidsline_receipt(all_text):
+                if not is_kidsline_receipt(join_page_texts(page_texts)):
                     return jsonify({
                         "error": f"{file.filename}: キッズラインの領収書形式ではありません",
                         "hint": "請求書形式のPDFは「テーブル抽出」機能をお使いください"
                     }), 400
                 
-                # データを抽出
-                data = parse_kidsline_receipt(all_text)
+                # 領収書ごとにデータを抽出（1か月分をまとめたPDFにも対応）
+                receipts = parse_kidsline_receipts(page_texts)
+                valid = [r['data'] for r in receipts if not r['error']]
                 
-                if not data['date'] or not data['start_time']:
+                if not valid:
                     return jsonify({
                         "error": f"{file.filename}: 利用日時が抽出できませんでした"
                     }), 400
                 
-                # 子供の名前と保護者名を保存（最初に見つかったもの）
-                if child_name is None and data['child_name']:
-                    child_name = data['child_name']
+                for error in kidsline_receipt_errors(receipts):
+                    receipt_errors.append(dict(error, filename=file.filename))
                 
-                # テーブル形式に変換
-                row = [
-                    data['date'],                           # ご利用日
-                    data['start_time'],                     # 開始時刻
-                    data['end_time'],                       # 終了時刻
-                    data['sitter_name'] or '',              # シッター名
-                    data['child_name'] or '',               # お子さま
-                    str(data['childcare_fee']),             # 保育料(非課税) - 助成対象
-                    '0',                                    # 保育料(税込10%)
-                    str(data['option_fee']),                # オプション料(税込10%)
-                    str(data['transport_fee']),             # 交通費(税込11%)
-                    '0',                                    # 特別費用(税込10%)
-                    '0',                                    # キャンセル料(不課税)
-                    '0',                                    # 割引額
-                    str(data['total_amount']),              # お支払い額
-                    str(data['childcare_fee'])              # 助成対象金額（保育料）
-                ]
-                extracted_rows.append(row)
+                for data in valid:
+                    # 子供の名前と保護者名を保存（最初に見つかったもの）
+                    if child_name is None and data['child_name']:
+                        child_name = data['child_name']
+                    
+                    # テーブル形式に変換
+                    extracted_rows.append(receipt_to_row(data))
         
         if len(extracted_rows) == 0:
             return jsonify({"error": "有効なデータが抽出できませんでした"}), 400
@@ -517,9 +1647,12 @@ def extract_kidsline():
             "rows": len(table),
             "columns": len(STANDARD_HEADER),
             "format": "kidsline",
-            "child_name": child_name
+            "child_name": child_name,
+            "errors": receipt_errors
         })
     
+    except LaneSaturatedError as e:
+        return lane_saturated_response(e)
     except Exception as e:
         return jsonify({"error": f"エラーが発生しました: {str(e)}"}), 500
 
@@ -544,38 +1677,49 @@ def detect_pdf_format():
             return jsonify({"error": "PDFファイルのみアップロード可能です"}), 400
         
         pdf_bytes = file.read()
-        pdf_file = io.BytesIO(pdf_bytes)
+        lane = choose_lane([inspect_upload(pdf_bytes)])
+        with lane.slot():
+            pdf_file = io.BytesIO(pdf_bytes)
         
-        with pdfplumber.open(pdf_file) as pdf:
-            if len(pdf.pages) == 0:
-                return jsonify({"error": "PDFにページがありません"}), 400
+            with pdfplumber.open(pdf_file) as pdf:
+                if len(pdf.pages) == 0:
+                    return jsonify({"error": "PDFにページがありません"}), 400
             
-            # 最初のページのテキストを取得
-            first_page = pdf.pages[0]
-            text = first_page.extract_text() or ''
+                # 先頭ページから事業者が分かるまでテキストを取得（最大 FORMAT_DETECT_MAX_PAGES ページ）
+                text = extract_pdf_text(pdf, max_pages=FORMAT_DETECT_MAX_PAGES, stop_when=_provider_found)
             
-            # フォーマットを判定
-            if is_kidsline_receipt(text):
-                return jsonify({
-                    "success": True,
-                    "format": "kidsline",
-                    "description": "キッズライン領収書形式"
-                })
-            else:
-                return jsonify({
-                    "success": True,
-                    "format": "invoice",
-                    "description": "請求書形式（テーブル）"
-                })
+                # フォーマットを判定
+                detection = classify_provider(text)
+                if detection['parser'] == 'kidsline':
+                    return jsonify({
+                        "success": True,
+                        "format": "kidsline",
+                        "description": "キッズライン領収書形式",
+                        **provider_fields(detection)
+                    })
+                else:
+                    return jsonify({
+                        "success": True,
+                        "format": "invoice",
+                        "description": "請求書形式（テーブル）",
+                        **provider_fields(detection)
+                    })
     
+    except LaneSaturatedError as e:
+        return lane_saturated_response(e)
     except Exception as e:
         return jsonify({"error": f"エラーが発生しました: {str(e)}"}), 500
 
 
+def _is_debug_request():
+    return request.args.get('debug', '').lower() in ('1', 'true', 'yes')
+
+
 @app.route('/api/extract-table', methods=['POST'])
 def extract_table():
     """
     PDFファイルの1ページ目から「ご利用日」ヘッダーを含むテーブルを抽出する
+    ?debug=1 を付けると診断情報（debug）も返す
     """
     try:
         # ファイルの取得
@@ -592,161 +1736,593 @@ def extract_table():
 
         # PDFを読み込み
         pdf_bytes = file.read()
-        pdf_file = io.BytesIO(pdf_bytes)
+        lane = choose_lane([inspect_upload(pdf_bytes)])
+        with lane.slot():
+            payload, status = extract_table_result(pdf_bytes)
+            if _is_debug_request():
+                payload['debug'] = table_diagnostics(pdf_bytes)
+            elif status != 200:
+                payload['hint'] = "診断情報は ?debug=1 または /api/extract-table/diagnostics で取得できます"
+
+        return jsonify(payload), status
+
+    except LaneSaturatedError as e:
+        return lane_saturated_response(e)
+    except Exception as e:
+        return jsonify({"error": f"エラーが発生しました: {str(e)}"}), 500
 
-        with pdfplumber.open(pdf_file) as pdf:
-            if len(pdf.pages) == 0:
-                return jsonify({"error": "PDFにページがありません"}), 400
 
-            # 1ページ目を取得
+def extract_table_result(pdf_bytes):
+    """
+    1ページ目から「ご利用日」ヘッダーを含むテーブルを抽出する
+    返り値: (レスポンスの辞書, ステータスコード)
+    """
+    with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
+        if len(pdf.pages) == 0:
+            return {"error": "PDFにページがありません"}, 400
+
+        # 1ページ目のテーブルを抽出
+        tables = pdf.pages[0].extract_tables()
+
+    if not tables:
+        return {"error": "テーブルが見つかりませんでした"}, 404
+
+    # すべてのテーブルから「ご利用日」セルを探索
+    target = find_usage_date_cell(tables)
+    if not target:
+        return {"error": "「ご利用日」を含むテーブルが見つかりませんでした"}, 404
+
+    # 「ご利用日」が含まれる行をヘッダー行、列を左端として切り出し、空行と「合計」行を除く
+    table_idx, row_idx, col_idx = target
+    cleaned_table = trim_invoice_table(tables[table_idx], row_idx, col_idx)
+
+    if not cleaned_table:
+        return {"error": "テーブルのトリミングに失敗しました"}, 500
+
+    # ヘッダー行（最初の行）が「ご利用日」で始まることを確認
+    if cleaned_table[0]:
+        normalized_first = cleaned_table[0][0].replace(' ', '').replace('　', '')
+        if not any(keyword in normalized_first for keyword in USAGE_DATE_KEYWORDS):
+            return {"error": "ヘッダー行の検証に失敗しました"}, 500
+
+    return {
+        "success": True,
+        "table": cleaned_table,
+        "rows": len(cleaned_table),
+        "columns": len(cleaned_table[0]) if cleaned_table and cleaned_table[0] else 0
+    }, 200
+
+
+# =============================================================================
+# 抽出の診断情報
+# =============================================================================
+# 抽出に失敗した請求書のサポート用。通常の抽出では計算せず、
+# ?debug=1 または /api/extract-table/diagnostics で要求されたときだけ作る。
+# 同じファイルの診断情報はSHA-256で保存して再利用する。
+
+DIAGNOSTICS_CACHE_DIR = os.path.join(RESULT_CACHE_DIR, 'diagnostics')
+
+
+def _diagnostics_cache_path(digest):
+    return os.path.join(DIAGNOSTICS_CACHE_DIR, f"v{EXTRACTION_CACHE_VERSION}", f"{digest}.json")
+
+
+def _clean_cells(table):
+    """Noneを空文字列にし、改行をスペースに置き換える"""
+    cleaned = []
+    for row in table:
+        if row:
+            cleaned.append([' '.join(str(cell).split()) if cell else "" for cell in row])
+    return cleaned
+
+
+def table_diagnostics(pdf_bytes):
+    """
+    1ページ目の表抽出の診断情報
+    - tables: 検出したすべての表（範囲・セル内容）
+    - anchor_trace: 「ご利用日」の候補セルと選ばれたセル
+    - header_mapping: ヘッダー列ごとの標準形式へのマッピングの判断
+    """
+    digest = content_hash(pdf_bytes)
+    cache_path = _diagnostics_cache_path(digest)
+    try:
+        with open(cache_path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        pass
+
+    diagnostics = {
+        "hash": digest,
+        "pages": 0,
+        "page_size": None,
+        "tables": [],
+        "anchor_trace": [],
+        "selected": None,
+        "header_mapping": []
+    }
+
+    with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
+        diagnostics["pages"] = len(pdf.pages)
+        if pdf.pages:
             first_page = pdf.pages[0]
+            diagnostics["page_size"] = [first_page.width, first_page.height]
+            found_tables = first_page.find_tables()
+            tables = [found.extract() for found in found_tables]
+
+            for table_idx, (found, table) in enumerate(zip(found_tables, tables)):
+                cleaned = _clean_cells(table)
+                diagnostics["tables"].append({
+                    "table_index": table_idx,
+                    "bbox": [round(v, 2) for v in found.bbox],
+                    "cells": len(found.cells),
+                    "rows": len(cleaned),
+                    "columns": len(cleaned[0]) if cleaned else 0,
+                    "data": cleaned
+                })
 
-            # テーブルを抽出
-            tables = first_page.extract_tables()
+            target = find_usage_date_cell(tables, trace=diagnostics["anchor_trace"])
+            if target:
+                table_idx, row_idx, col_idx = target
+                diagnostics["selected"] = {"table_index": table_idx, "row": row_idx, "column": col_idx}
+                cleaned_table = trim_invoice_table(tables[table_idx], row_idx, col_idx)
+                if cleaned_table:
+                    build_header_indices(cleaned_table[0], trace=diagnostics["header_mapping"])
 
-            if not tables:
-                return jsonify({"error": "テーブルが見つかりませんでした"}), 404
-
-            # デバッグ用：すべてのテーブルをクリーンアップ
-            debug_tables = []
-            for table_idx, table in enumerate(tables):
-                if table:
-                    cleaned = []
-                    for row in table:
-                        if row:
-                            cleaned_row = []
-                            for cell in row:
-                                if cell:
-                                    # 改行を削除してスペースに置き換え
-                                    cell_str = str(cell).replace('\n', ' ').replace('\r', ' ').strip()
-                                    cell_str = ' '.join(cell_str.split())
-                                    cleaned_row.append(cell_str)
-                                else:
-                                    cleaned_row.append("")
-                            cleaned.append(cleaned_row)
-                    debug_tables.append({
-                        "table_index": table_idx,
-                        "rows": len(cleaned),
-                        "columns": len(cleaned[0]) if cleaned else 0,
-                        "data": cleaned
-                    })
+    try:
+        write_json_atomic(cache_path, diagnostics)
+        _prune_result_cache(os.path.dirname(cache_path))
+    except OSError:
+        pass
+    return diagnostics
 
-            # すべてのテーブルから「ご利用日」セルを探索
-            # 複数見つかった場合は最も短い（最も具体的な）セルを選ぶ
-            target_table = None
-            target_row_idx = None
-            target_col_idx = None
-            min_cell_length = float('inf')
-
-            for table in tables:
-                if not table or len(table) == 0:
-                    continue
 
-                # テーブル全体を探索して「ご利用日」を探す
-                # 複数のバリエーションに対応（全角/半角、異体字など）
-                for row_idx, row in enumerate(table):
-                    if not row:
-                        continue
-
-                    for col_idx, cell in enumerate(row):
-                        if cell:
-                            cell_str = str(cell).strip()
-                            # 「ご利用日」の様々なバリエーションをチェック
-                            # Unicode正規化やスペース削除も考慮
-                            normalized_cell = cell_str.replace(' ', '').replace('　', '')
-
-                            if ('ご利用日' in normalized_cell or
-                                'ご利⽤⽇' in normalized_cell or  # 縦書き用文字
-                                '利用日' in normalized_cell or
-                                '利⽤⽇' in normalized_cell):
-                                # 最も短いセルを優先（PDF全文ではなく、ヘッダーセルを選ぶため）
-                                cell_length = len(normalized_cell)
-                                if cell_length < min_cell_length:
-                                    target_table = table
-                                    target_row_idx = row_idx
-                                    target_col_idx = col_idx
-                                    min_cell_length = cell_length
-
-            if not target_table:
-                # デバッグ情報を含めてエラーを返す
-                return jsonify({
-                    "error": "「ご利用日」を含むテーブルが見つかりませんでした",
-                    "debug": {
-                        "tables_found": len(tables),
-                        "all_tables": debug_tables
-                    }
-                }), 404
-
-            # 「ご利用日」が含まれる行をヘッダー行として、その行から抽出を開始
-            # 「ご利用日」が含まれる列から右側のみを抽出
-            trimmed_table = []
-
-            # target_row_idx行目（ヘッダー行）から下をすべて抽出
-            for row in target_table[target_row_idx:]:
-                if row and len(row) > target_col_idx:
-                    # target_col_idx列目から右側を抽出
-                    trimmed_row = row[target_col_idx:]
-                    trimmed_table.append(trimmed_row)
-
-            # 空行と「合計」行を削除
-            filtered_table = []
-            for row in trimmed_table:
-                if not row or not any(cell for cell in row):
-                    continue  # 空行をスキップ
-
-                # 行内のすべてのセルを結合して「合計」が含まれているかチェック
-                row_text = ''.join([str(cell).replace(' ', '').replace('　', '') for cell in row if cell])
-
-                # 「合計」が含まれる行はスキップ
-                if '合計' in row_text or '⼩計' in row_text:
-                    continue
+@app.route('/api/extract-table/diagnostics', methods=['POST'])
+def extract_table_diagnostics():
+    """PDFの表抽出の診断情報を返す（サポート用）"""
+    try:
+        if 'file' not in request.files:
+            return jsonify({"error": "ファイルがアップロードされていません"}), 400
 
-                filtered_table.append(row)
-
-            if not filtered_table:
-                return jsonify({"error": "テーブルのトリミングに失敗しました"}), 500
-
-            trimmed_table = filtered_table
-
-            # ヘッダー行（最初の行）が「ご利用日」で始まることを確認
-            if trimmed_table and trimmed_table[0]:
-                first_cell = str(trimmed_table[0][0]).strip() if trimmed_table[0][0] else ""
-                normalized_first = first_cell.replace(' ', '').replace('　', '')
-                if not any(keyword in normalized_first for keyword in ['ご利用日', 'ご利⽤⽇', '利用日', '利⽤⽇']):
-                    return jsonify({"error": "ヘッダー行の検証に失敗しました"}), 500
-
-            # Noneを空文字列に変換し、改行を削除
-            cleaned_table = []
-            for row in trimmed_table:
-                if row:
-                    cleaned_row = []
-                    for cell in row:
-                        if cell:
-                            # 改行を削除してスペースに置き換え、前後の空白を削除
-                            cell_str = str(cell).replace('\n', ' ').replace('\r', ' ').strip()
-                            # 連続する空白を1つにまとめる
-                            cell_str = ' '.join(cell_str.split())
-                            cleaned_row.append(cell_str)
-                        else:
-                            cleaned_row.append("")
-                    cleaned_table.append(cleaned_row)
-                else:
-                    cleaned_table.append([])
+        file = request.files['file']
+
+        if file.filename == '':
+            return jsonify({"error": "ファイル名が空です"}), 400
+
+        if not file.filename.lower().endswith('.pdf'):
+            return jsonify({"error": "PDFファイルのみアップロード可能です"}), 400
+
+        pdf_bytes = file.read()
+        lane = choose_lane([inspect_upload(pdf_bytes)])
+        with lane.slot():
+            diagnostics = table_diagnostics(pdf_bytes)
 
-            return jsonify({
-                "success": True,
-                "table": cleaned_table,
-                "rows": len(cleaned_table),
-                "columns": len(cleaned_table[0]) if cleaned_table and cleaned_table[0] else 0
-            })
+        return jsonify(dict(diagnostics, success=True, filename=file.filename))
 
+    except LaneSaturatedError as e:
+        return lane_saturated_response(e)
     except Exception as e:
         return jsonify({"error": f"エラーが発生しました: {str(e)}"}), 500
 
+
+# =============================================================================
+# 日中 / 夜間の利用時間の分割
+# =============================================================================
+# 杉並区の様式では 7時～22時 を日中、22時～翌7時 を夜間として記載欄を分ける。
+# 利用時間をまとめて配列演算で境界と突き合わせるため、行数が多くても高速に計算できる。
+# 終了時刻が開始時刻より前の場合は日付をまたいだ利用（例: 21:00～翌1:00）として扱う。
+
+MINUTES_PER_DAY = 24 * 60
+
+
+def parse_clock(time_str):
+    """「9:00」「09:00」形式の時刻を0時からの分に変換する（変換できなければNone）"""
+    match = re.match(r'^\s*(\d{1,2})[:：](\d{2})\s*$', time_str or '')
+    if not match:
+        return None
+    hours, minutes = int(match.group(1)), int(match.group(2))
+    if hours > 24 or minutes >= 60 or hours * 60 + minutes > MINUTES_PER_DAY:
+        return None
+    return hours * 60 + minutes
+
+
+def format_clock(minutes):
+    """0時からの分を「HH:MM」形式に変換する（24時以降は翌日の時刻）"""
+    minutes = int(minutes) % MINUTES_PER_DAY
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+def format_duration(minutes):
+    """分を「H時間MM分」形式に変換する"""
+    minutes = int(minutes)
+    return f"{minutes // 60}時間{minutes % 60:02d}分"
+
+
+def _boundary_from_env(name, default):
+    """時間帯の境界を環境変数から読む（不正な値なら起動時にエラーにする）"""
+    value = os.environ.get(name, default)
+    minutes = parse_clock(value)
+    if minutes is None or minutes >= MINUTES_PER_DAY:
+        raise ValueError(f"{name} は「H:MM」形式の時刻で指定してください: {value!r}")
+    return minutes
+
+
+DAY_START_MINUTES = _boundary_from_env('DAY_START_TIME', '7:00')
+NIGHT_START_MINUTES = _boundary_from_env('NIGHT_START_TIME', '22:00')
+if DAY_START_MINUTES >= NIGHT_START_MINUTES:
+    raise ValueError("DAY_START_TIME は NIGHT_START_TIME より前の時刻にしてください")
+
+
+def format_boundary(minutes):
+    """時間帯の境界を様式の表記（「7時」「7時30分」）に変換する"""
+    return f"{minutes // 60}時{minutes % 60}分" if minutes % 60 else f"{minutes // 60}時"
+
+
+def period_labels():
+    """申請書の記載欄の見出しに使う日中・夜間の時間帯（例: 7時～22時 / 22時～翌7時）"""
+    day_start = format_boundary(DAY_START_MINUTES)
+    night_start = format_boundary(NIGHT_START_MINUTES)
+    return {"day": f"{day_start}～{night_start}", "night": f"{night_start}～翌{day_start}"}
+
+
+def split_day_night(start_minutes, end_minutes, day_start=None, night_start=None):
+    """
+    利用時間をまとめて日中と夜間に分割する
+    start_minutes, end_minutes: 開始・終了時刻（0時からの分）の配列
+    返り値: (日中の分の配列, 夜間の分の配列)
+    """
+    day_start = DAY_START_MINUTES if day_start is None else day_start
+    night_start = NIGHT_START_MINUTES if night_start is None else night_start
+
+    starts = np.asarray(start_minutes, dtype=np.int64)
+    ends = np.asarray(end_minutes, dtype=np.int64)
+    # 日付をまたぐ利用は終了時刻を翌日にずらす
+    ends = np.where(ends < starts, ends + MINUTES_PER_DAY, ends)
+    total = ends - starts
+
+    # 当日と翌日の日中の時間帯との重なりを合計する
+    day = np.zeros_like(total)
+    for offset in (0, MINUTES_PER_DAY):
+        window_start = day_start + offset
+        window_end = night_start + offset
+        overlap = np.minimum(ends, window_end) - np.maximum(starts, window_start)
+        day += np.clip(overlap, 0, None)
+
+    return day, total - day
+
+
+def period_ranges(start, end, day_start=None, night_start=None):
+    """
+    1回の利用を日中・夜間の時間帯ごとの区間に分ける（表示用）
+    返り値: (日中の区間リスト, 夜間の区間リスト) 各区間は (開始分, 終了分)
+    """
+    day_start = DAY_START_MINUTES if day_start is None else day_start
+    night_start = NIGHT_START_MINUTES if night_start is None else night_start
+    if end < start:
+        end += MINUTES_PER_DAY
+
+    # 境界で区切り、各区間の中点がどちらの時間帯かで振り分ける
+    cuts = {start, end}
+    for offset in (0, MINUTES_PER_DAY):
+        for boundary in (day_start + offset, night_start + offset):
+            if start < boundary < end:
+                cuts.add(boundary)
+    points = sorted(cuts)
+
+    day_ranges, night_ranges = [], []
+    for seg_start, seg_end in zip(points, points[1:]):
+        midpoint = (seg_start + seg_end) / 2 % MINUTES_PER_DAY
+        target = day_ranges if day_start <= midpoint < night_start else night_ranges
+        if target and target[-1][1] == seg_start:
+            target[-1] = (target[-1][0], seg_end)
+        else:
+            target.append((seg_start, seg_end))
+    return day_ranges, night_ranges
+
+
+def format_ranges(ranges, start, end, start_str, end_str):
+    """区間リストを「9:00 ～ 10:00」形式にする（元の時刻表記はそのまま使う）"""
+    if end < start:
+        end += MINUTES_PER_DAY
+    labels = []
+    for seg_start, seg_end in ranges:
+        seg_start_str = start_str if seg_start == start else format_clock(seg_start)
+        seg_end_str = end_str if seg_end == end else format_clock(seg_end)
+        labels.append(f"{seg_start_str} ～ {seg_end_str}")
+    return '、'.join(labels)
+
+
+# =============================================================================
+# 申請書のページ割り付け
+# =============================================================================
+# 申請書の1ページ目は1か月分（10行）、2ページ目以降は2つの表（12行・7行）を記載できる。
+# 月ごとの行数から各表に載せる行をサーバー側で決め、フォームはページのリストをそのまま描画する。
+# 1か月分が1つの表に収まらない場合は次の表に続け、表の合計欄にはその時点までの小計を記載して
+# 次の表へ繰り越す。月の途中から始まる表は1行目に前の表からの繰越額を記載する（利用行は1行少ない）。
+
+FIRST_PAGE_ROWS = int(os.environ.get('FIRST_PAGE_ROWS', 10))
+CONTINUATION_PAGE_ROWS = tuple(
+    int(n) for n in os.environ.get('CONTINUATION_PAGE_ROWS', '12,7').split(',') if n.strip()
+)
+# 繰越行は表の行を1つ使うため、続きを載せる表には2行以上必要
+if FIRST_PAGE_ROWS < 2 or not CONTINUATION_PAGE_ROWS or min(CONTINUATION_PAGE_ROWS) < 2:
+    raise ValueError("FIRST_PAGE_ROWS と CONTINUATION_PAGE_ROWS の各表の行数は2以上にしてください")
+
+
+def sum_rows(rows):
+    """行の日中・夜間の分と実支払額を合計する"""
+    return {
+        "day_minutes": sum(r['day_minutes'] for r in rows),
+        "night_minutes": sum(r['night_minutes'] for r in rows),
+        "amount": sum(r['subsidy_amount'] for r in rows)
+    }
+
+
+def add_totals(a, b):
+    return {key: a[key] + b[key] for key in a}
+
+
+def format_totals(totals):
+    """合計欄の表示形式（夜間の利用がなければ夜間は空欄）"""
+    return {
+        "dayTotalTime": format_duration(totals['day_minutes']),
+        "nightTotalTime": format_duration(totals['night_minutes']) if totals['night_minutes'] > 0 else "",
+        "totalAmount": f"{totals['amount']:,}"
+    }
+
+
+def iter_table_slots(first_page_rows=None, continuation_page_rows=None):
+    """
+    申請書の表の記載欄を先頭から順に返す
+    返り値: (ページ番号, 表の行数) を無限に返すイテレータ
+    """
+    first_page_rows = FIRST_PAGE_ROWS if first_page_rows is None else first_page_rows
+    continuation_page_rows = continuation_page_rows or CONTINUATION_PAGE_ROWS
+    yield 1, first_page_rows
+    page_number = 2
+    while True:
+        for capacity in continuation_page_rows:
+            yield page_number, capacity
+        page_number += 1
+
+
+def layout_month(month, month_rows, slots):
+    """
+    1か月分の行を表に割り付ける
+    slots: (ページ番号, 表の行数) のイテレータ（使った分だけ進む）
+    返り値: [(ページ番号, 表の内容)]
+    """
+    sections = []
+    offset = 0
+    carried = {"day_minutes": 0, "night_minutes": 0, "amount": 0}
+    part = 1
+    while True:
+        page_number, capacity = next(slots)
+        # 月の途中から始まる表は1行目が前の表からの繰越行になる
+        row_capacity = capacity - 1 if offset > 0 else capacity
+        chunk = month_rows[offset:offset + row_capacity]
+        subtotal = add_totals(carried, sum_rows(chunk))
+        continues = offset + row_capacity < len(month_rows)
+
+        section = {
+            "month": month,
+            "part": part,
+            # 表の行数（繰越行がある場合は繰越行を含む）
+            "capacity": capacity,
+            # 表に載せる行（monthsの月のsourcesの start から end の手前まで）
+            "start": offset,
+            "end": offset + len(chunk),
+            # 前の表からの繰越（月の最初の表ではNone）。表の1行目に記載する
+            "carriedIn": format_totals(carried) if offset > 0 else None,
+            "continues": continues
+        }
+        # 合計欄はこの表までの小計（月の最後の表では月の合計）
+        section.update(format_totals(subtotal))
+        sections.append((page_number, section))
+
+        if not continues:
+            return sections
+        offset += row_capacity
+        carried = subtotal
+        part += 1
+
+
+def paginate_claim(monthly_data, sorted_months, first_page_rows=None, continuation_page_rows=None, pages=None):
+    """
+    月ごとの行を申請書のページと表に割り付ける
+    各月は新しい表から始め、表に収まらない行は次の表（必要なら次のページ）に続ける
+    pages: 割り付け済みのページ（その続きの表から割り付ける）
+    返り値: [{"number": ページ番号, "sections": [表ごとの内容]}]
+    """
+    slots = iter_table_slots(first_page_rows, continuation_page_rows)
+    pages = [] if pages is None else pages
+    for _ in range(sum(len(page['sections']) for page in pages)):
+        next(slots)
+    for month in sorted_months:
+        for page_number, section in layout_month(month, monthly_data[month], slots):
+            if not pages or pages[-1]['number'] != page_number:
+                pages.append({"number": page_number, "sections": []})
+            pages[-1]['sections'].append(section)
+    return pages
+
+
+def parse_table_row(row):
+    """抽出テーブルの1行を利用記録にする（日付が読めない行はNone）"""
+    if len(row) < 14:
+        return None
+
+    # 日付から月を抽出（例: "2025/07/12" -> "7"）
+    date_str = row[0]
+    if not date_str or '/' not in date_str:
+        return None
+
+    parts = date_str.split('/')
+    if len(parts) < 3:
+        return None
+
+    month = parts[1].lstrip('0')  # "07" -> "7"
+    day = parts[2].lstrip('0')    # "12" -> "12"
+
+    # 助成対象金額を抽出（カンマを削除）
+    subsidy_amount_str = row[13].replace(',', '')
+    try:
+        subsidy_amount = int(subsidy_amount_str) if subsidy_amount_str else 0
+    except:
+        subsidy_amount = 0
+
+    return {
+        "month": month,
+        "day": day,
+        "start_time": row[1],  # "10:00"
+        "end_time": row[2],    # "15:45"
+        "start": parse_clock(row[1]),
+        "end": parse_clock(row[2]),
+        "subsidy_amount": subsidy_amount
+    }
+
+
+def build_form_rows(sessions):
+    """
+    利用記録を申請書の行にする（利用時間の日中・夜間の分割はまとめて計算する）
+    返り値: (月, 行) のリスト
+    """
+    # 全行の利用時間を日中と夜間にまとめて分割
+    valid = [s for s in sessions if s['start'] is not None and s['end'] is not None]
+    if valid:
+        day_minutes, night_minutes = split_day_night(
+            [s['start'] for s in valid], [s['end'] for s in valid]
+        )
+        for session, day_min, night_min in zip(valid, day_minutes.tolist(), night_minutes.tolist()):
+            session['day_minutes'] = day_min
+            session['night_minutes'] = night_min
+
+    form_rows = []
+    for session in sessions:
+        start, end = session['start'], session['end']
+        if start is None or end is None:
+            # 時刻が読めない行は時間数を空欄にする
+            day_time = f"{session['start_time']} ～ {session['end_time']}"
+            day_duration = ""
+            night_time = ""
+            night_duration = ""
+            day_min = 0
+            night_min = 0
+        elif session['day_minutes'] == 0 or session['night_minutes'] == 0:
+            # 日中または夜間だけの利用（大半の行）は区間を分けずにそのまま記載する
+            day_min = session['day_minutes']
+            night_min = session['night_minutes']
+            label = f"{session['start_time']} ～ {session['end_time']}" if day_min or night_min else ""
+            day_time = label if day_min else ""
+            night_time = label if night_min else ""
+            day_duration = format_duration(day_min) if day_min > 0 else ""
+            night_duration = format_duration(night_min) if night_min > 0 else ""
+        else:
+            day_min = session['day_minutes']
+            night_min = session['night_minutes']
+            day_ranges, night_ranges = period_ranges(start, end)
+            day_time = format_ranges(day_ranges, start, end, session['start_time'], session['end_time'])
+            night_time = format_ranges(night_ranges, start, end, session['start_time'], session['end_time'])
+            day_duration = format_duration(day_min) if day_min > 0 else ""
+            night_duration = format_duration(night_min) if night_min > 0 else ""
+
+        subsidy_amount = session['subsidy_amount']
+        form_rows.append((session['month'], {
+            "date": session['day'],
+            "dayTime": day_time,
+            "dayDuration": day_duration,
+            "nightTime": night_time,
+            "nightDuration": night_duration,
+            "amount": f"{subsidy_amount:,}",
+            "month": session['month'],
+            "subsidy_amount": subsidy_amount,
+            "day_minutes": day_min,
+            "night_minutes": night_min,
+            # 抽出テーブルの何行目か（再計算で行を指定するのに使う）
+            "source": session['source']
+        }))
+    return form_rows
+
+
+def month_summary(totals):
+    """月ごとの合計欄と補助基準額"""
+    day_hours = totals['day_minutes'] // 60
+    night_hours = totals['night_minutes'] // 60
+
+    # 補助基準額の計算: 日中利用時間 × 2500円 + 夜間利用時間 × 3500円
+    subsidy_amount = (day_hours * 2500) + (night_hours * 3500)
+    # 交付請求額は補助基準額と実際の合計金額の小さい方
+    request_amount = min(subsidy_amount, totals['amount'])
+
+    return {
+        **format_totals(totals),
+        "dayHours": str(day_hours),
+        "nightHours": str(night_hours),
+        "subsidyAmount": f"{subsidy_amount:,}",
+        "requestAmount": f"{request_amount:,}",
+        "usageHours": str(day_hours + night_hours)
+    }
+
+
+def claim_summary(month_totals):
+    """全月の合計（1ページ目の「他ページ含む総計」と補助基準額・交付請求額）"""
+    totals = {"day_minutes": 0, "night_minutes": 0, "amount": 0}
+    for month_total in month_totals.values():
+        totals = add_totals(totals, month_total)
+
+    summary = month_summary(totals)
+    return {
+        "grandTotalDayTime": summary['dayTotalTime'],
+        "grandTotalNightTime": summary['nightTotalTime'],
+        "grandTotalAmount": summary['totalAmount'],
+        "dayHours": summary['dayHours'],
+        "nightHours": summary['nightHours'],
+        "subsidyAmount": summary['subsidyAmount'],
+        "requestAmount": summary['requestAmount'],
+        "usageHours": summary['usageHours']
+    }
+
+
+def build_claim(monthly_data):
+    """
+    月ごとの行からform_data.json形式のデータを作る
+    行は rows に抽出テーブルの行番号（source）をキーにして1回だけ持つ
+    月ごとの行番号の並びは months の sources に、ページの表はその範囲（start・end）を持つ
+    返り値: (申請データ, 月ごとの合計)
+    """
+    # 月を昇順にソート
+    sorted_months = sorted(monthly_data.keys(), key=lambda x: int(x))
+    month_totals = {month: sum_rows(monthly_data[month]) for month in sorted_months}
+
+    # form_data.json形式に変換
+    pages = paginate_claim(monthly_data, sorted_months)
+    claim = {
+        "year": "7",  # デフォルト値（令和7年）
+        "applicantName": "杉並 なみ",  # デフォルト値
+        "childName": "杉並 すけ",  # デフォルト値
+        "month": sorted_months[0],
+        # 記載欄の見出しの時間帯（DAY_START_TIME・NIGHT_START_TIME から作る）
+        "periods": period_labels(),
+        "rows": {
+            str(row['source']): row for month in sorted_months for row in monthly_data[month]
+        },
+        "months": {
+            month: {
+                **month_summary(month_totals[month]),
+                "sources": [row['source'] for row in monthly_data[month]]
+            }
+            for month in sorted_months
+        },
+        "summary": claim_summary(month_totals),
+        "pages": pages,
+        "totalPages": len(pages)
+    }
+    return claim, month_totals
+
+
 @app.route('/api/convert-to-json', methods=['POST'])
 def convert_to_json():
     """
     抽出されたテーブルデータをform_data.json形式に変換する
+    変換結果はclaimIdで保存し、/api/convert-to-json/recalculate で行ごとに再計算できる
     """
     try:
         data = request.json
@@ -758,181 +2334,606 @@ def convert_to_json():
             return jsonify({"error": "データ行が必要です"}), 400
 
         # ヘッダー行をスキップしてデータ行のみを取得
-        rows = table[1:]
+        sessions = []
+        for source, row in enumerate(table[1:], start=1):
+            session = parse_table_row(row)
+            if session:
+                session['source'] = source
+                sessions.append(session)
 
         # 月ごとにデータをグループ化
         monthly_data = {}
+        for month, form_row in build_form_rows(sessions):
+            monthly_data.setdefault(month, []).append(form_row)
 
-        for row in rows:
-            if len(row) < 14:
-                continue
+        if not monthly_data:
+            return jsonify({"error": "有効なデータが見つかりませんでした"}), 400
 
-            # 日付から月を抽出（例: "2025/07/12" -> "7"）
-            date_str = row[0]
-            if not date_str or '/' not in date_str:
-                continue
+        claim, month_totals = build_claim(monthly_data)
+        claim['claimId'] = uuid.uuid4().hex
+        claim['revision'] = 0
+        store_claim_state(claim, month_totals)
 
-            parts = date_str.split('/')
-            if len(parts) < 3:
-                continue
+        return jsonify({
+            "success": True,
+            "data": claim
+        })
 
-            month = parts[1].lstrip('0')  # "07" -> "7"
-            day = parts[2].lstrip('0')    # "12" -> "12"
+    except Exception as e:
+        return jsonify({"error": f"変換エラー: {str(e)}"}), 500
 
-            # 時間を抽出
-            start_time = row[1]  # "10:00"
-            end_time = row[2]    # "15:45"
 
-            # 助成対象金額を抽出（カンマを削除）
-            subsidy_amount_str = row[13].replace(',', '')
-            try:
-                subsidy_amount = int(subsidy_amount_str) if subsidy_amount_str else 0
-            except:
-                subsidy_amount = 0
+# =============================================================================
+# 編集した申請データの再計算
+# =============================================================================
+# JSONエディタで1行を編集するたびに全行を変換し直すと、行数の多い申請では編集が重くなる。
+# 変換結果はサーバーにclaimIdで保存しておき、エディタは変更した行（抽出テーブルの行番号で指定）
+# だけを送る。サーバーは変更された行だけを日中・夜間に分割し、その行の月の合計を差分で更新する。
+# 他の月の合計はサーバーに保存した値を使い、クライアントから受け取った合計は使わない。
+# レスポンスは変更された行・月・表と全体の合計だけを返す。行数が変わらない変更では
+# その月の表だけを計算し直し、行の追加・削除で割り付けが変わった場合はその月以降のページを返す。
+# 申請データはファイルに保存して複数のワーカーで共有し、変更は申請データごとの記録ファイルに追記する。
+# 記録ファイルのロック（flock）の中で版を確認してから適用するため、同じ版に対する変更は1つだけが通る。
 
-            # 時間計算（簡易版）
-            day_time = f"{start_time} ～ {end_time}"
+CLAIM_STATE_DIR = os.path.join(RESULT_CACHE_DIR, 'claims')
+CLAIM_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+# 各ワーカーがメモリに持つ申請データの件数
+CLAIM_MEMORY_ENTRIES = int(os.environ.get('CLAIM_MEMORY_ENTRIES', 32))
+# 変更の記録がこの件数に達したら申請データ全体を保存し直す
+CLAIM_LOG_COMPACT_EVERY = int(os.environ.get('CLAIM_LOG_COMPACT_EVERY', 50))
+CLAIM_CHANGE_OPS = ('add', 'update', 'delete')
 
-            # 時間数を計算
-            try:
-                start_h, start_m = map(int, start_time.split(':'))
-                end_h, end_m = map(int, end_time.split(':'))
-                total_minutes = (end_h * 60 + end_m) - (start_h * 60 + start_m)
-                hours = total_minutes // 60
-                minutes = total_minutes % 60
-                day_duration = f"{hours}時間{minutes:02d}分"
-            except:
-                day_duration = ""
-                total_minutes = 0
-
-            # 月ごとのデータに追加
-            if month not in monthly_data:
-                monthly_data[month] = []
-
-            monthly_data[month].append({
-                "date": day,
-                "dayTime": day_time,
-                "dayDuration": day_duration,
-                "nightTime": "",
-                "nightDuration": "",
-                "amount": f"{subsidy_amount:,}",
-                "subsidy_amount": subsidy_amount,
-                "day_minutes": total_minutes,
-                "night_minutes": 0
-            })
-
-        # 月を昇順にソート
-        sorted_months = sorted(monthly_data.keys(), key=lambda x: int(x))
-
-        if not sorted_months:
-            return jsonify({"error": "有効なデータが見つかりませんでした"}), 400
+_claim_states = {}
+_claim_states_lock = threading.Lock()
 
-        # form_data.json形式に変換
-        result = {
-            "year": "7",  # デフォルト値（令和7年）
-            "applicantName": "杉並 なみ",  # デフォルト値
-            "childName": "杉並 すけ",  # デフォルト値
-            "month": sorted_months[0]
-        }
 
-        # 最初の月のデータをpage1に
-        first_month = sorted_months[0]
-        first_month_rows = monthly_data[first_month]
-
-        day_total_minutes = sum(r['day_minutes'] for r in first_month_rows)
-        night_total_minutes = sum(r['night_minutes'] for r in first_month_rows)
-        day_total_hours = day_total_minutes // 60
-        day_total_mins = day_total_minutes % 60
-        night_total_hours = night_total_minutes // 60
-        night_total_mins = night_total_minutes % 60
-        total_amount = sum(r['subsidy_amount'] for r in first_month_rows)
-
-        # 全月の合計を計算（page1の他ページ含む総計用）
-        all_day_minutes = 0
-        all_night_minutes = 0
-        all_total_amount = 0
-        for month in sorted_months:
-            month_rows = monthly_data[month]
-            all_day_minutes += sum(r['day_minutes'] for r in month_rows)
-            all_night_minutes += sum(r['night_minutes'] for r in month_rows)
-            all_total_amount += sum(r['subsidy_amount'] for r in month_rows)
-
-        all_day_hours = all_day_minutes // 60
-        all_day_mins = all_day_minutes % 60
-        all_night_hours = all_night_minutes // 60
-        all_night_mins = all_night_minutes % 60
-
-        # 補助基準額の計算: 日中利用時間 × 2500円 + 夜間利用時間 × 3500円
-        calculated_subsidy_amount = (all_day_hours * 2500) + (all_night_hours * 3500)
-
-        # 交付請求額は補助基準額と実際の合計金額の小さい方
-        request_amount = min(calculated_subsidy_amount, all_total_amount)
-
-        result["page1"] = {
-            "rows": first_month_rows,
-            "dayTotalTime": f"{day_total_hours}時間{day_total_mins:02d}分",
-            "nightTotalTime": f"{night_total_hours}時間{night_total_mins:02d}分" if night_total_hours > 0 else "",
-            "totalAmount": f"{total_amount:,}",
-            # 以下は全月の合計を使用（補助基準額の計算に使用）
-            "dayHours": str(all_day_hours),
-            "nightHours": str(all_night_hours),
-            "subsidyAmount": f"{calculated_subsidy_amount:,}",
-            "requestAmount": f"{request_amount:,}",
-            "usageHours": str(all_day_hours + all_night_hours),
-            "grandTotalDayTime": f"{all_day_hours}時間{all_day_mins:02d}分",
-            "grandTotalNightTime": f"{all_night_hours}時間{all_night_mins:02d}分" if all_night_hours > 0 else "",
-            "grandTotalAmount": f"{all_total_amount:,}"
-        }
+def _claim_state_path(claim_id):
+    return os.path.join(CLAIM_STATE_DIR, f"v{EXTRACTION_CACHE_VERSION}", f"{claim_id}.json")
 
-        # 2番目以降の月がある場合はpage2に
-        if len(sorted_months) > 1:
-            result["page2"] = {
-                "grandTotal": {
-                    "totalDayHours": str(all_day_hours),
-                    "totalNightHours": str(all_night_hours),
-                    "totalSubsidyAmount": f"{calculated_subsidy_amount:,}",
-                    "totalRequestAmount": f"{request_amount:,}",
-                    "totalUsageHours": str(all_day_hours + all_night_hours)
-                }
-            }
 
-            for idx, month in enumerate(sorted_months[1:], start=1):
-                month_rows = monthly_data[month]
-                month_day_minutes = sum(r['day_minutes'] for r in month_rows)
-                month_night_minutes = sum(r['night_minutes'] for r in month_rows)
-                month_day_hours = month_day_minutes // 60
-                month_day_mins = month_day_minutes % 60
-                month_night_hours = month_night_minutes // 60
-                month_night_mins = month_night_minutes % 60
-                month_total_amount = sum(r['subsidy_amount'] for r in month_rows)
-
-                # 月ごとの補助基準額を計算
-                month_subsidy_amount = (month_day_hours * 2500) + (month_night_hours * 3500)
-                month_request_amount = min(month_subsidy_amount, month_total_amount)
-
-                result["page2"][f"month{idx}"] = month
-                result["page2"][f"table{idx}"] = {
-                    "rows": month_rows,
-                    "dayTotalTime": f"{month_day_hours}時間{month_day_mins:02d}分",
-                    "nightTotalTime": f"{month_night_hours}時間{month_night_mins:02d}分" if month_night_hours > 0 else "",
-                    "totalAmount": f"{month_total_amount:,}",
-                    "dayHours": str(month_day_hours),
-                    "nightHours": str(month_night_hours),
-                    "subsidyAmount": f"{month_subsidy_amount:,}",
-                    "requestAmount": f"{month_request_amount:,}",
-                    "usageHours": str(month_day_hours + month_night_hours)
-                }
+def _claim_log_path(claim_id):
+    return os.path.join(CLAIM_STATE_DIR, f"v{EXTRACTION_CACHE_VERSION}", f"{claim_id}.log")
+
+
+def _remember_claim_state(state):
+    with _claim_states_lock:
+        _claim_states.pop(state['claim']['claimId'], None)
+        _claim_states[state['claim']['claimId']] = state
+        while len(_claim_states) > CLAIM_MEMORY_ENTRIES:
+            _claim_states.pop(next(iter(_claim_states)))
+
+
+def _forget_claim_state(claim_id):
+    with _claim_states_lock:
+        _claim_states.pop(claim_id, None)
+
+
+@contextmanager
+def locked_claim_log(claim_id):
+    """
+    申請データの変更の記録を開き、排他ロック（flock）を取る
+    ロックはファイルごとに取るため、別のワーカー・別のスレッドから同じ申請データを同時に更新することはなく、
+    別の申請データの更新は待たされない
+    """
+    path = _claim_log_path(claim_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a+', encoding='utf-8') as log:
+        fcntl.flock(log, fcntl.LOCK_EX)
+        try:
+            yield log
+        finally:
+            fcntl.flock(log, fcntl.LOCK_UN)
+
+
+def read_claim_log(log):
+    """変更の記録を読む（書きかけの行があればそこまで）"""
+    log.seek(0)
+    entries = []
+    for line in log:
+        try:
+            entry = json.loads(line)
+            entry['revision']
+        except (ValueError, KeyError, TypeError):
+            break
+        entries.append(entry)
+    return entries
+
+
+def _reset_claim_log(log, revision):
+    """変更の記録を空にして、保存した申請データの版だけを書く"""
+    log.seek(0)
+    log.truncate()
+    log.write(json.dumps({"revision": revision}) + '\n')
+    log.flush()
+
+
+def store_claim_state(claim, month_totals, log=None):
+    """
+    申請データと月ごとの合計を保存する（他のワーカーからも読めるようファイルにも書く）
+    これまでの変更の記録は保存した内容に含まれるので空にする
+    log: ロック済みの変更の記録（省略時はここでロックを取る）
+    """
+    state = {"claim": claim, "month_totals": month_totals}
+    _remember_claim_state(state)
+    path = _claim_state_path(claim['claimId'])
+    try:
+        write_json_atomic(path, state)
+        if log is None:
+            with locked_claim_log(claim['claimId']) as log:
+                _reset_claim_log(log, claim['revision'])
+        else:
+            _reset_claim_log(log, claim['revision'])
+        _prune_result_cache(os.path.dirname(path), companions=('.log',))
+    except OSError:
+        pass
+
+
+def record_claim_changes(state, changes, log):
+    """
+    適用した変更をロック済みの記録に追記する
+    1行の編集ごとに申請データ全体を書き直すと行数に比例して遅くなるため、ファイルには変更だけを追記し、
+    CLAIM_LOG_COMPACT_EVERY 回ごとに全体を保存し直す
+    """
+    claim = state['claim']
+    if claim['revision'] % CLAIM_LOG_COMPACT_EVERY == 0:
+        store_claim_state(claim, state['month_totals'], log)
+        return
+    _remember_claim_state(state)
+    try:
+        log.write(json.dumps({"revision": claim['revision'], "changes": changes}, ensure_ascii=False) + '\n')
+        log.flush()
+        # 古いものから削除する際に、編集中の申請データを残す
+        os.utime(_claim_state_path(claim['claimId']))
+    except OSError:
+        pass
+
+
+def load_claim_state(claim_id, entries):
+    """
+    保存済みの申請データを返す。なければNone
+    entries: 変更の記録（read_claim_log の結果）
+    メモリの内容が記録の最新の版と違う（他のワーカーが更新した）場合はファイルから読み直し、記録された変更を順に適用する
+    """
+    latest = entries[-1]['revision'] if entries else None
+    with _claim_states_lock:
+        state = _claim_states.get(claim_id)
+    if state is not None and state['claim']['revision'] == latest:
+        return state
+    try:
+        with open(_claim_state_path(claim_id), encoding='utf-8') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    for entry in entries:
+        # 保存し直した時点の版（changesのない行）やそれより前の記録は読み飛ばす
+        if entry.get('changes') is not None and entry['revision'] == state['claim']['revision'] + 1:
+            apply_claim_changes(state, entry['changes'])
+    _remember_claim_state(state)
+    return state
+
+
+def validate_claim_changes(changes):
+    """行の変更を検証して正規化する（不正な場合はValueError）"""
+    if not isinstance(changes, list):
+        raise ValueError("changesはリストで指定してください")
+    normalized = []
+    for index, change in enumerate(changes):
+        if not isinstance(change, dict):
+            raise ValueError(f"changes[{index}] はオブジェクトで指定してください")
+        op = change.get('op')
+        if op not in CLAIM_CHANGE_OPS:
+            raise ValueError(f"changes[{index}] の操作が不明です: {op}")
+
+        source = change.get('source')
+        if not isinstance(source, int) or isinstance(source, bool) or source < 1:
+            raise ValueError(f"changes[{index}] の行番号（source）は1以上の整数で指定してください")
+
+        row = None
+        if op != 'delete':
+            row = change.get('row')
+            if not isinstance(row, list) or not all(cell is None or isinstance(cell, str) for cell in row):
+                raise ValueError(f"changes[{index}] の行（row）は文字列のリストで指定してください")
+            row = [cell or '' for cell in row]
+        normalized.append({"op": op, "source": source, "row": row})
+    return normalized
+
+
+def subtract_totals(a, b):
+    return {key: a[key] - b[key] for key in a}
+
+
+def apply_claim_changes(state, changes):
+    """
+    保存済みの申請データに行の変更を適用する（stateを更新する）
+    返り値: クライアントに返す差分
+    """
+    claim = state['claim']
+    month_totals = state['month_totals']
+    rows = claim['rows']
+    months = claim['months']
+
+    # 月ごとの行番号（抽出テーブルの行順）
+    month_sources = {month: list(summary['sources']) for month, summary in months.items()}
+    counts_before = {month: len(sources) for month, sources in month_sources.items()}
+
+    changed_rows = {}
+    affected = set()
+    added = {}
+
+    for change in changes:
+        source = change['source']
+        key = str(source)
+        if change['op'] == 'add' and (key in rows or source in added):
+            raise ValueError(f"行番号 {source} の行はすでにあります")
+
+        # 変更前の行を月の合計から差し引く（updateは新しい行として入れ直す）
+        old = rows.pop(key, None)
+        if old is not None:
+            month = old['month']
+            month_totals[month] = subtract_totals(month_totals[month], sum_rows([old]))
+            month_sources[month].remove(source)
+            affected.add(month)
+            changed_rows[key] = None
+        added.pop(source, None)
+
+        if change['op'] != 'delete':
+            session = parse_table_row(change['row'])
+            # 日付が読めない行は変換時と同じく申請書に載せない
+            if session:
+                session['source'] = source
+                added[source] = session
+            else:
+                changed_rows[key] = None
+
+    # 追加・変更された行だけを日中・夜間に分割し、その月の合計に加える
+    for month, form_row in build_form_rows(list(added.values())):
+        key = str(form_row['source'])
+        rows[key] = form_row
+        changed_rows[key] = form_row
+        month_totals[month] = add_totals(
+            month_totals.get(month, {"day_minutes": 0, "night_minutes": 0, "amount": 0}), sum_rows([form_row])
+        )
+        # 変換時と同じく抽出テーブルの行順に並べる
+        bisect.insort(month_sources.setdefault(month, []), form_row['source'])
+        affected.add(month)
+
+    for month in affected:
+        if not month_sources[month]:
+            del month_sources[month]
+            month_totals.pop(month, None)
+    if not month_sources:
+        raise ValueError("有効なデータが見つかりませんでした")
+
+    patch = {"rows": changed_rows, "months": {}}
+    for month in affected:
+        if month in month_sources:
+            months[month] = {**month_summary(month_totals[month]), "sources": month_sources[month]}
+        else:
+            months.pop(month, None)
+        patch['months'][month] = months.get(month)
+
+    summary = claim_summary(month_totals)
+    if summary != claim['summary']:
+        claim['summary'] = patch['summary'] = summary
+
+    sorted_months = sorted(month_sources, key=int)
+    if sorted_months[0] != claim['month']:
+        claim['month'] = patch['month'] = sorted_months[0]
+
+    changed_counts = [
+        month for month in set(counts_before) | set(month_sources)
+        if counts_before.get(month) != len(month_sources.get(month, ()))
+    ]
+    if changed_counts:
+        # 行数が変わった月から後ろは表の位置が変わるため、その月から割り付けをやり直す
+        first_changed = min(int(month) for month in changed_counts)
+        pages = []
+        for page in claim['pages']:
+            sections = [section for section in page['sections'] if int(section['month']) < first_changed]
+            if not sections:
+                break
+            pages.append({"number": page['number'], "sections": sections})
+        pages_from = max(len(pages) - 1, 0)
+        later_months = [month for month in sorted_months if int(month) >= first_changed]
+        monthly_data = {month: [rows[str(s)] for s in month_sources[month]] for month in later_months}
+        pages = paginate_claim(monthly_data, later_months, pages=pages)
+
+        claim['pages'] = pages
+        patch['pagesFrom'] = pages_from
+        patch['pages'] = pages[pages_from:]
+        if len(pages) != claim['totalPages']:
+            claim['totalPages'] = patch['totalPages'] = len(pages)
+    else:
+        # 割り付けは変わらないので、変更のあった月の表の小計だけを計算し直す
+        patch['sections'] = []
+        for month in sorted(affected, key=int):
+            positions = [
+                (page_index, section_index, page['number'], section['capacity'])
+                for page_index, page in enumerate(claim['pages'])
+                for section_index, section in enumerate(page['sections'])
+                if section['month'] == month
+            ]
+            slots = iter([(number, capacity) for _, _, number, capacity in positions])
+            month_rows = [rows[str(s)] for s in month_sources[month]]
+            for (page_index, section_index, _, _), (_, section) in zip(positions, layout_month(month, month_rows, slots)):
+                claim['pages'][page_index]['sections'][section_index] = section
+                patch['sections'].append({"page": page_index, "index": section_index, "section": section})
+
+    claim['revision'] += 1
+    patch['revision'] = claim['revision']
+    return patch
+
+
+@app.route('/api/convert-to-json/recalculate', methods=['POST'])
+def recalculate_claim():
+    """
+    /api/convert-to-json で保存した申請データに行の追加・変更・削除を適用し、差分を返す
+    リクエスト: {"claimId": "...", "revision": 0, "changes": [{"op": "update", "source": 3, "row": [...]}]}
+    """
+    try:
+        data = request.json
+        if not isinstance(data, dict):
+            return jsonify({"error": "claimId・revision・changesが必要です"}), 400
+
+        claim_id = data.get('claimId')
+        revision = data.get('revision')
+        if not isinstance(claim_id, str) or not CLAIM_ID_PATTERN.match(claim_id):
+            return jsonify({"error": "claimIdが不正です"}), 400
+        if not isinstance(revision, int) or isinstance(revision, bool):
+            return jsonify({"error": "revisionは整数で指定してください"}), 400
+        try:
+            changes = validate_claim_changes(data.get('changes'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        if not os.path.exists(_claim_state_path(claim_id)):
+            return jsonify({"error": "申請データが見つかりません。変換し直してください"}), 404
+
+        # 版の確認から記録までを申請データごとのロックの中で行う
+        # （同じ版に対する2つの変更は、後から来た方が409になる）
+        with locked_claim_log(claim_id) as log:
+            state = load_claim_state(claim_id, read_claim_log(log))
+            if state is None:
+                return jsonify({"error": "申請データが見つかりません。変換し直してください"}), 404
+            if state['claim']['revision'] != revision:
+                return jsonify({
+                    "error": "申請データが他の画面で更新されています。変換し直してください",
+                    "revision": state['claim']['revision']
+                }), 409
+
+            try:
+                patch = apply_claim_changes(state, changes)
+            except Exception as e:
+                # 途中まで適用したメモリ上の内容は捨て、保存済みの内容に戻す
+                _forget_claim_state(claim_id)
+                if isinstance(e, ValueError):
+                    return jsonify({"error": str(e)}), 400
+                raise
+            record_claim_changes(state, changes, log)
 
         return jsonify({
             "success": True,
-            "data": result
+            "claimId": claim_id,
+            "patch": patch
         })
 
     except Exception as e:
-        return jsonify({"error": f"変換エラー: {str(e)}"}), 500
+        return jsonify({"error": f"再計算エラー: {str(e)}"}), 500
+
+
+# =============================================================================
+# ASGIモード（uvicorn app:asgi_app で起動）
+# =============================================================================
+# WSGIではスマートフォンからの遅いアップロードを受信し終えるまでワーカーが占有される。
+# ASGIモードではリクエスト本文を非同期に受信して一時ファイル（小さい場合はメモリ）に溜め、
+# 受信が終わってからFlaskアプリ（pdfplumberの処理を含む）をスレッドプールで実行する。
+# アップロード（multipart）はレーンの空きを待つ間スレッドを持ち続けるため、
+# /health や /api/convert-to-json などとは別のスレッドプールで実行する。
+# エンドポイントとレスポンスの形式はWSGIの場合と同じ。
+
+# アップロード以外のリクエストを実行するスレッド数
+ASGI_WORKER_THREADS = int(os.environ.get('ASGI_WORKER_THREADS', 4))
+# アップロードを実行するスレッド数（既定はレーンの同時実行数と待ち行列の合計で、
+# レーンに入れたリクエストが実行用のスレッドを待つことはない）
+ASGI_UPLOAD_THREADS = int(os.environ.get(
+    'ASGI_UPLOAD_THREADS',
+    sum(lane.max_concurrency + lane.max_queue for lane in (FAST_LANE, HEAVY_LANE))
+))
+ASGI_MAX_BODY_BYTES = int(os.environ.get('ASGI_MAX_BODY_BYTES', 50 * 1024 * 1024))
+# これより大きい本文はメモリではなく一時ファイルに溜める
+ASGI_SPOOL_MEMORY_BYTES = int(os.environ.get('ASGI_SPOOL_MEMORY_BYTES', 1024 * 1024))
+
+
+class AsgiAdapter:
+    """
+    WSGIアプリをASGIで動かすアダプター
+    本文の受信はイベントループで行い、アプリの実行だけをスレッドプールに渡す
+    """
+
+    def __init__(self, wsgi_app, max_workers=ASGI_WORKER_THREADS, upload_workers=ASGI_UPLOAD_THREADS):
+        self.wsgi_app = wsgi_app
+        self.pool_sizes = {'default': max_workers, 'upload': upload_workers}
+        self._executors = {}
+
+    def executor(self, kind):
+        if kind not in self._executors:
+            self._executors[kind] = ThreadPoolExecutor(
+                max_workers=self.pool_sizes[kind], thread_name_prefix=f'asgi-{kind}'
+            )
+        return self._executors[kind]
+
+    @staticmethod
+    def _header(scope, name):
+        for raw_name, raw_value in scope.get('headers', []):
+            if raw_name.lower() == name:
+                return raw_value.decode('latin-1')
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        # Content-Lengthで上限を超えると分かる場合は本文を受信せずに断る
+        declared = self._header(scope, b'content-length')
+        if declared and declared.strip().isdigit() and int(declared) > ASGI_MAX_BODY_BYTES:
+            await self._send_too_large(send)
+            return
+
+        body = tempfile.SpooledTemporaryFile(max_size=ASGI_SPOOL_MEMORY_BYTES)
+        try:
+            received = await self._receive_body(receive, body)
+            if received is None:
+                # 受信中に切断された
+                return
+            if received > ASGI_MAX_BODY_BYTES:
+                await self._send_too_large(send)
+                return
+
+            body.seek(0)
+            environ = self._build_environ(scope, body, received)
+            content_type = self._header(scope, b'content-type') or ''
+            kind = 'upload' if content_type.lower().startswith('multipart/form-data') else 'default'
+            loop = asyncio.get_running_loop()
+            status, headers, chunks = await loop.run_in_executor(self.executor(kind), self._run_wsgi, environ)
+            await self._send_response(send, status, headers, chunks)
+        finally:
+            body.close()
+
+    async def _send_too_large(self, send):
+        # Flaskを通らないレスポンスなので、flask-cors（全オリジン許可）と同じヘッダーを付ける
+        await self._send_response(send, '413 Request Entity Too Large', [
+            ('Content-Type', 'application/json'),
+            ('Access-Control-Allow-Origin', '*')
+        ], [json.dumps({"error": "ファイルサイズが大きすぎます"}, ensure_ascii=False).encode('utf-8')])
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                for executor in self._executors.values():
+                    executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _receive_body(self, receive, body):
+        """本文を受信して書き込み、バイト数を返す（切断された場合はNone）"""
+        received = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return None
+            chunk = message.get('body', b'')
+            received += len(chunk)
+            if received > ASGI_MAX_BODY_BYTES:
+                # Content-Lengthのない本文が上限を超えた時点で受信をやめる（413を返す）
+                return received
+            if chunk:
+                body.write(chunk)
+            if not message.get('more_body', False):
+                return received
+
+    def _build_environ(self, scope, body, content_length):
+        """ASGIのscopeからWSGIのenvironを作る（PEP 3333）"""
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': str(server[0]),
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'REMOTE_ADDR': str(client[0]),
+            'CONTENT_LENGTH': str(content_length),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        for raw_name, raw_value in scope.get('headers', []):
+            name = raw_name.decode('latin-1').upper().replace('-', '_')
+            value = raw_value.decode('latin-1')
+            if name == 'CONTENT_TYPE':
+                environ['CONTENT_TYPE'] = value
+                continue
+            if name == 'CONTENT_LENGTH':
+                continue
+            key = f'HTTP_{name}'
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+
+    def _run_wsgi(self, environ):
+        """スレッドプールでWSGIアプリを実行し、レスポンスをまとめて返す"""
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = status
+            response['headers'] = headers
+
+        result = self.wsgi_app(environ, start_response)
+        try:
+            chunks = [chunk for chunk in result if chunk]
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return response['status'], response['headers'], chunks
+
+    async def _send_response(self, send, status, headers, chunks):
+        await send({
+            'type': 'http.response.start',
+            'status': int(status.split(' ', 1)[0]),
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+        })
+        await send({'type': 'http.response.body', 'body': b''.join(chunks)})
+
+
+asgi_app = AsgiAdapter(app)
+
+record_startup_event('app_ready')
+
+# 起動後に軽いモジュールを裏で読み込んでおく（既定はnumpy）
+# /api/convert-to-json は最初の呼び出しから即座に応答する必要があるため、
+# 初回のリクエストでnumpyの読み込み（約70ms）を待たないようにする。
+# pdfplumberは抽出自体に時間がかかるため、既定では最初の抽出時に読み込む。
+PRELOAD_LAZY_IMPORTS = [
+    name.strip() for name in os.environ.get('PRELOAD_LAZY_IMPORTS', 'numpy').split(',') if name.strip()
+]
+
+
+def _preload_lazy_modules(names):
+    for name in names:
+        module = LazyModule.instances.get(name)
+        if module is not None:
+            module._load()
+
+
+if PRELOAD_LAZY_IMPORTS:
+    threading.Thread(
+        target=_preload_lazy_modules, args=(PRELOAD_LAZY_IMPORTS,), name='preload-imports', daemon=True
+    ).start()
+
+# STARTUP_REPORT=1 の場合は起動時にimport時間の内訳（上位10件）を出力
+if os.environ.get('STARTUP_REPORT') == '1':
+    for item in startup_report()['imports'][:10]:
+        app.logger.info(f"[startup] import {item['module']}: {item['seconds'] * 1000:.1f}ms")
+    app.logger.info(f"[startup] app ready: {STARTUP_EVENTS['app_ready'] * 1000:.1f}ms")
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     # Gunicorn経由で起動される場合はこのブロックは実行されない
-    # 開発環境でのみ使用
-    app.run(host='0.0.0.0', port=port, debug=False)
+    # 開発環境でのみ使用（SERVER_MODE=asgi の場合はuvicornで起動）
+    if os.environ.get('SERVER_MODE') == 'asgi':
+        import uvicorn
+        uvicorn.run(asgi_app, host='0.0.0.0', port=port)
+    else:
+        app.run(host='0.0.0.0', port=port, debug=False)